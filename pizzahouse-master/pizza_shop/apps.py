@@ -1,5 +1,11 @@
 from django.apps import AppConfig
+from django.core import checks
 
 
 class PizzaShopConfig(AppConfig):
     name = 'pizza_shop'
+
+    def ready(self):
+        import pizza_shop.signals  # noqa
+        from pizza_shop.cartstore import check_cart_cache
+        checks.register(check_cart_cache, checks.Tags.caches)
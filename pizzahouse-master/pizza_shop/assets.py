@@ -0,0 +1,93 @@
+import gzip
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Fonts like woff/woff2 and images are compressed already
+COMPRESSIBLE = ('.css', '.js', '.svg', '.eot', '.ttf', '.json', '.txt', '.map')
+# Names produced by ManifestStaticFilesStorage, e.g. bootstrap.min.3c4f1b2a9d0e.css
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# Unhashed names may change with the next build
+SHORT_LIVED = 'public, max-age=300'
+
+
+def compress(content):
+    """Precompressed variants of a file: [(suffix, bytes)], only those smaller than the original"""
+    variants = [('.gz', gzip.compress(content, 9))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content, quality=11)))
+    return [(suffix, data) for suffix, data in variants if len(data) < len(content)]
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Hashed names plus .gz (and .br when the brotli package is installed) copies written
+    next to every text asset, so nothing has to be compressed per request.
+    """
+
+    def post_process(self, *args, **kwargs):
+        for name, hashed_name, processed in super(CompressedManifestStaticFilesStorage, self).post_process(
+                *args, **kwargs):
+            if hashed_name and processed and hashed_name.endswith(COMPRESSIBLE):
+                with self.open(hashed_name) as f:
+                    content = f.read()
+                for suffix, data in compress(content):
+                    if self.exists(hashed_name + suffix):
+                        self.delete(hashed_name + suffix)
+                    self._save(hashed_name + suffix, ContentFile(data))
+            yield name, hashed_name, processed
+
+    def stored_name(self, name):
+        # Before the first build_static there is neither a manifest nor STATIC_ROOT, keep plain names
+        if not self.hashed_files and not self.exists(name):
+            return name
+        return super(CompressedManifestStaticFilesStorage, self).stored_name(name)
+
+
+def serve_asset(request, path):
+    """
+    Serves a built asset from STATIC_ROOT, picking the precompressed variant the client accepts.
+    Hashed names never change, so they are cached for a year.
+    """
+    try:
+        fullpath = safe_join(settings.STATIC_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(fullpath):
+        raise Http404
+
+    content_type, encoding = mimetypes.guess_type(fullpath)
+    accepted = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    served, content_encoding = fullpath, encoding
+    for suffix, name in (('.br', 'br'), ('.gz', 'gzip')):
+        if not encoding and name in accepted and os.path.isfile(fullpath + suffix):
+            served, content_encoding = fullpath + suffix, name
+            break
+
+    stat = os.stat(served)
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime, stat.st_size):
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(open(served, 'rb'), content_type=content_type or 'application/octet-stream')
+        response['Content-Length'] = stat.st_size
+        if content_encoding:
+            response['Content-Encoding'] = content_encoding
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = IMMUTABLE if HASHED_NAME.search(path) else SHORT_LIVED
+    return response
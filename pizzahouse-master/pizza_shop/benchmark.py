@@ -0,0 +1,337 @@
+"""
+Synthetic catalog generator and load benchmark, driven by the bench_generate and bench_run commands.
+Everything is seeded, two runs with the same options hit the same pages in the same order.
+"""
+import json
+import math
+import multiprocessing
+import random
+import threading
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from pizza_shop.catalog import bump_catalog_version
+from pizza_shop.models import Section, SubSection, Meal, MealImage, Ingredient, IngredientType, Cart, CartMeal, \
+    order_states, OrderStates
+from pizza_shop.sampling import meal_sampler
+from pizza_shop.search import search_index
+
+PREFIX = 'bench'
+SCALES = {
+    'small': dict(sections=2, subsections=3, meals=10, images=2, ingredients=30, users=20, carts=200, lines=3),
+    'medium': dict(sections=4, subsections=5, meals=50, images=3, ingredients=200, users=1000, carts=50000,
+                   lines=4),
+    'large': dict(sections=6, subsections=8, meals=200, images=3, ingredients=1000, users=20000,
+                  carts=2000000, lines=4),
+}
+WORDS = ('пицца', 'острая', 'сырная', 'маргарита', 'пепперони', 'грибная', 'мясная', 'овощная', 'гавайская',
+         'салями', 'ветчина', 'томаты', 'моцарелла', 'курица', 'бекон', 'оливки', 'перец', 'лук', 'чеснок')
+BATCH_SIZE = 5000
+USER_PASSWORD = 'bench-password'
+
+
+def _batches(objects, size=BATCH_SIZE):
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def clear_dataset():
+    """Removes everything generate_dataset() created, other data is left alone"""
+    Cart.objects.filter(owner__username__startswith=PREFIX).delete()
+    Cart.objects.filter(token__startswith=PREFIX.upper()).delete()
+    User.objects.filter(username__startswith=PREFIX).delete()
+    Ingredient.objects.filter(title__startswith=PREFIX).delete()
+    IngredientType.objects.filter(title__startswith=PREFIX).delete()
+    Section.objects.filter(link__startswith=PREFIX).delete()
+
+
+def generate_dataset(seed=1, sections=2, subsections=3, meals=10, images=2, ingredients=30, users=20, carts=200,
+                     lines=3, log=None):
+    """
+    Bulk inserts a catalog and its traffic: subsections/meals/images are per parent, carts are spread
+    over the users and anonymous sessions, a third of them are placed orders.
+    """
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+
+    with transaction.atomic():
+        Section.objects.bulk_create(
+            Section(link='%s%d' % (PREFIX, s), title='Раздел %d' % s, img='sec_img/bench.jpg')
+            for s in range(sections))
+        SubSection.objects.bulk_create(
+            SubSection(link='%s%d_%d' % (PREFIX, s, b), title='Подраздел %d.%d' % (s, b),
+                       sec_id='%s%d' % (PREFIX, s), img='subsec_img/bench.jpg')
+            for s in range(sections) for b in range(subsections))
+        meal_links, prices = [], {}
+        for batch in _batches(
+                Meal(link='%s%d_%d_%d' % (PREFIX, s, b, m), subsec_id='%s%d_%d' % (PREFIX, s, b),
+                     title=' '.join(rng.sample(WORDS, 3)).capitalize(), descr=' '.join(rng.sample(WORDS, 8)),
+                     keywords=' '.join(rng.sample(WORDS, 2)), price=rng.randrange(150, 1500, 10), weight='500')
+                for s in range(sections) for b in range(subsections) for m in range(meals)):
+            Meal.objects.bulk_create(batch)
+            meal_links.extend(meal.link for meal in batch)
+            prices.update((meal.link, meal.price) for meal in batch)
+        for batch in _batches(MealImage(meal_id=link, img='images_bench/%s_%d.jpg' % (link, i))
+                              for link in meal_links for i in range(images)):
+            MealImage.objects.bulk_create(batch)
+        log('%d meals, %d images' % (len(meal_links), len(meal_links) * images))
+
+        ingredient_type = IngredientType.objects.create(title='%s ингредиенты' % PREFIX)
+        Ingredient.objects.bulk_create(
+            Ingredient(title='%s %s %d' % (PREFIX, rng.choice(WORDS), i), type=ingredient_type)
+            for i in range(ingredients))
+        ingredient_ids = list(Ingredient.objects.filter(type=ingredient_type).values_list('id', flat=True))
+        through = Ingredient.inside.through
+        for batch in _batches(through(ingredient_id=ingredient_id, meal_id=link)
+                              for link in meal_links
+                              for ingredient_id in rng.sample(ingredient_ids, min(5, len(ingredient_ids)))):
+            through.objects.bulk_create(batch)
+
+        # Hashing a password per user would dominate the run, they all share one
+        password = make_password(USER_PASSWORD)
+        for batch in _batches(User(username='%s%d' % (PREFIX, u), password=password) for u in range(users)):
+            User.objects.bulk_create(batch)
+        user_ids = list(User.objects.filter(username__startswith=PREFIX).values_list('id', flat=True))
+        log('%d users' % len(user_ids))
+
+    open_state, unpaid, paid = (order_states.id(OrderStates.PENDING), order_states.id(OrderStates.UNPAID),
+                                order_states.id(OrderStates.PAID))
+    created = 0
+    while created < carts:
+        count = min(BATCH_SIZE, carts - created)
+        with transaction.atomic():
+            batch = []
+            for i in range(count):
+                archive = bool(user_ids) and rng.random() < 0.33
+                cart_lines = rng.sample(meal_links, min(lines, len(meal_links)))
+                amounts = [rng.randint(1, 3) for link in cart_lines]
+                batch.append(Cart(
+                    owner_id=rng.choice(user_ids) if archive or (user_ids and rng.random() < 0.3) else None,
+                    token='%s%035X' % (PREFIX.upper(), rng.getrandbits(140)), archive=archive,
+                    status_id=rng.choice((unpaid, paid)) if archive else open_state,
+                    total_amount=sum(amounts),
+                    total_price=sum(amount * prices[link] for link, amount in zip(cart_lines, amounts)),
+                    version=1))
+                batch[-1].lines = list(zip(cart_lines, amounts))
+            Cart.objects.bulk_create(batch)
+            # bulk_create leaves the ids unset on SQLite, read them back by token
+            ids = dict(Cart.objects.filter(token__in=[cart.token for cart in batch]).values_list('token', 'id'))
+            CartMeal.objects.bulk_create(
+                CartMeal(cart_id=ids[cart.token], meal_id=link, amount=amount, price=prices[link])
+                for cart in batch for link, amount in cart.lines)
+        created += count
+        log('%d carts' % created)
+
+    bump_catalog_version()
+    meal_sampler.invalidate()
+    search_index.build()
+
+
+def percentile(values, p):
+    # Nearest rank, values must be sorted
+    if not values:
+        return 0
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+class Workload(object):
+    """Picks the pages of every scenario, each client gets its own seeded random stream"""
+
+    def __init__(self, seed):
+        self.seed = seed
+        meals = list(Meal.objects.filter(link__startswith=PREFIX).select_related('subsec').order_by('link'))
+        if not meals:
+            raise ValueError('No benchmark data, run bench_generate first')
+        self.meals = [(meal.link, meal.subsec_id, meal.subsec.sec_id) for meal in meals]
+        self.users = list(User.objects.filter(username__startswith=PREFIX, carts__archive=True).distinct()
+                          .order_by('id').values_list('username', flat=True)[:1000])
+
+    def catalog(self, client, rng):
+        link, subsec, sec = rng.choice(self.meals)
+        return rng.choice((
+            lambda: client.get('/'),
+            lambda: client.get('/%s/' % sec),
+            lambda: client.get('/%s/%s/' % (sec, subsec)),
+            lambda: client.get('/%s/%s/%s/' % (sec, subsec, link)),
+        ))()
+
+    def search(self, client, rng):
+        return client.post('/handler/', {'type': 'search', 'meal': rng.choice(WORDS)},
+                           HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def cart(self, client, rng):
+        link = rng.choice(self.meals)[0]
+        data = rng.choice(({'type': 'add', 'meal': link}, {'type': 'set', 'meal': link, 'amount': rng.randint(1, 5)},
+                           {'type': 'del', 'meal': link}))
+        return client.post('/handler/', data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def login(self, client, rng):
+        if not self.users:
+            raise ValueError('No benchmark users with orders')
+        client.login(username=rng.choice(self.users), password=USER_PASSWORD)
+
+    def checkout(self, client, rng):
+        client.post('/handler/', {'type': 'add', 'meal': rng.choice(self.meals)[0]},
+                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        return client.get('/accounts/order/')
+
+    def account(self, client, rng):
+        return client.get('/accounts/profile/')
+
+
+SCENARIOS = {
+    'catalog': ('catalog', False),
+    'search': ('search', False),
+    'cart': ('cart', False),
+    'checkout': ('checkout', True),
+    'account': ('account', True),
+}
+
+
+def run_client(workload, scenario, number, requests, warmup, results, stop=None):
+    """Makes warmup + requests requests, or requests until stop is set when it is given"""
+    method, needs_login = SCENARIOS[scenario]
+    rng = random.Random('%s-%s-%d' % (workload.seed, scenario, number))
+    client = Client(HTTP_HOST='localhost')
+    if needs_login:
+        workload.login(client, rng)
+    step = getattr(workload, method)
+    i = 0
+    while (i < warmup + requests) if stop is None else not stop.is_set():
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            try:
+                failed = step(client, rng).status_code >= 400
+            except Exception:
+                # The test client raises what a view raised, "database is locked" among others
+                failed = True
+            elapsed = time.time() - start
+        if i >= warmup:
+            results.append((elapsed, len(queries), failed))
+        i += 1
+
+
+def _client_thread(*args):
+    try:
+        run_client(*args)
+    finally:
+        # Every thread opened its own connection
+        connection.close()
+
+
+def _background_worker(seed, scenario, clients, stop, queue):
+    # Runs in a process of its own, its writes contend for the database like another worker's
+    workload = Workload(seed)
+    results = []
+    threads = [threading.Thread(target=_client_thread, args=(workload, scenario, 100 + n, 0, 0, results, stop))
+               for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue.put((len(results), sum(1 for elapsed, queries, failed in results if failed)))
+
+
+def run_benchmark(scenarios, clients=4, requests=100, warmup=10, seed=1, background=None, background_clients=2):
+    """
+    Runs every scenario with `clients` concurrent test clients, `requests` requests each.
+    With a background scenario, `background_clients` more clients in another process run it while each
+    scenario is measured, e.g. cart writes against catalog reads.
+    """
+    workload = Workload(seed)
+    report = {}
+    for scenario in scenarios:
+        results = []
+        if background:
+            # The forked process must not share the connection of this one
+            connection.close()
+            stop, queue = multiprocessing.Event(), multiprocessing.Queue()
+            process = multiprocessing.Process(target=_background_worker,
+                                              args=(seed, background, background_clients, stop, queue))
+            process.start()
+        start = time.time()
+        if clients == 1:
+            # The test database of an in-memory SQLite is only visible to this thread
+            run_client(workload, scenario, 0, requests, warmup, results)
+        else:
+            threads = [threading.Thread(target=_client_thread, args=(workload, scenario, n, requests, warmup, results))
+                       for n in range(clients)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        wall = time.time() - start
+        if background:
+            stop.set()
+            background_requests, background_errors = queue.get()
+            process.join()
+        latencies = sorted(elapsed for elapsed, queries, failed in results)
+        queries = [queries for elapsed, queries, failed in results]
+        report[scenario] = {
+            'requests': len(results),
+            'errors': sum(1 for elapsed, queries, failed in results if failed),
+            'throughput': round(len(results) / wall, 2) if wall else 0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'queries_mean': round(sum(queries) / len(queries), 2) if queries else 0,
+            'queries_max': max(queries) if queries else 0,
+        }
+        if background:
+            report[scenario].update({
+                'background_requests': background_requests,
+                'background_errors': background_errors,
+            })
+    return report
+
+
+def compare_reports(baseline, current, threshold=20):
+    """Lines describing regressions of current against baseline: slower p95, lower throughput, more queries"""
+    regressions = []
+    for scenario, stats in sorted(current.items()):
+        base = baseline.get(scenario)
+        if not base:
+            continue
+        if base['p95_ms'] and stats['p95_ms'] > base['p95_ms'] * (1 + threshold / 100.0):
+            regressions.append('%s: p95 %.1fms -> %.1fms' % (scenario, base['p95_ms'], stats['p95_ms']))
+        if base['throughput'] and stats['throughput'] < base['throughput'] * (1 - threshold / 100.0):
+            regressions.append('%s: throughput %.1f -> %.1f req/s' % (scenario, base['throughput'],
+                                                                       stats['throughput']))
+        if stats['queries_max'] > base['queries_max']:
+            regressions.append('%s: up to %d queries, was %d' % (scenario, stats['queries_max'], base['queries_max']))
+    return regressions
+
+
+def save_report(path, report, options):
+    with open(path, 'w') as f:
+        json.dump({'options': options, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'scenarios': report}, f,
+                  indent=2, sort_keys=True)
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)['scenarios']
+
+
+def summarize(report):
+    lines = ['%-10s %8s %7s %10s %9s %9s %9s %8s' % ('scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+                                                       'p99 ms', 'queries')]
+    for scenario, stats in sorted(report.items()):
+        lines.append('%-10s %8d %7d %10.1f %9.1f %9.1f %9.1f %8.1f' % (
+            scenario, stats['requests'], stats['errors'], stats['throughput'], stats['p50_ms'], stats['p95_ms'],
+            stats['p99_ms'], stats['queries_mean']))
+        if 'background_requests' in stats:
+            lines.append('%-10s %8d %7d   meanwhile in the background' % (
+                '', stats['background_requests'], stats['background_errors']))
+    return lines
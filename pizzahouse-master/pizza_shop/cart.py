@@ -0,0 +1,253 @@
+from django.core.urlresolvers import reverse
+from django.db import transaction, IntegrityError
+from django.db.models import Prefetch, F
+from django.utils import timezone
+
+from pizza_shop.cartstore import LiveCart, live_store_enabled, empty_state, load_live_cart, start_live_cart, \
+    change_live_cart, save_live_cart, discard_live_cart, set_amount
+from pizza_shop.database import serialized_write
+from pizza_shop.models import Cart, CartMeal, Meal
+
+CART_ID_SESSION_KEY = 'cart_id'
+CART_TOKEN_SESSION_KEY = 'cart_token'
+
+
+def open_carts(with_lines=True):
+    # Open carts together with their lines and meals, two queries in total
+    carts = Cart.objects.filter(archive=False)
+    if with_lines:
+        carts = carts.prefetch_related(
+            Prefetch('cartmeal_set', queryset=CartMeal.objects.select_related('meal__subsec'))
+        )
+    return carts
+
+
+def find_cart(request, with_lines=True):
+    """
+    Looks up the open cart of the current session or user, returns None if there is none.
+    Cart mutations pass with_lines=False, they never read the prefetched lines.
+    """
+    user = request.user
+    token = request.session.get(CART_TOKEN_SESSION_KEY, '')
+    cart = None
+
+    if token:
+        cart_id = request.session.get(CART_ID_SESSION_KEY)
+        if cart_id:
+            # Primary key lookup, the token check keeps stale sessions out
+            cart = open_carts(with_lines).filter(pk=cart_id, token=token).first()
+        if cart is None:
+            cart = open_carts(with_lines).filter(token=token).order_by('-creation_date').first()
+        if cart is not None and user.is_authenticated() and cart.owner_id != user.pk:
+            cart = None
+    elif user.is_authenticated():
+        cart = open_carts(with_lines).filter(owner=user).order_by('-creation_date').first()
+    return cart
+
+
+def remember_cart(request, cart):
+    # Touch the session only when something changed, otherwise it is saved on every request
+    if request.session.get(CART_TOKEN_SESSION_KEY) != cart.token:
+        request.session[CART_TOKEN_SESSION_KEY] = cart.token
+    if request.session.get(CART_ID_SESSION_KEY) != cart.pk:
+        request.session[CART_ID_SESSION_KEY] = cart.pk
+
+
+def forget_cart(request):
+    token = request.session.get(CART_TOKEN_SESSION_KEY)
+    if token and live_store_enabled():
+        discard_live_cart(token)
+    request.session[CART_TOKEN_SESSION_KEY] = ''
+    request.session.pop(CART_ID_SESSION_KEY, None)
+
+
+def materialize_cart(request, cart):
+    # Placeholder carts get a row (or a store entry) only when something is put into them
+    if isinstance(cart, LiveCart):
+        if cart.token is None:
+            live = start_live_cart(owner_id=cart.owner_id)
+            cart.token = live.token
+            cart.update(live.state)
+            request.session[CART_TOKEN_SESSION_KEY] = cart.token
+    elif cart.pk is None:
+        cart.save()
+        remember_cart(request, cart)
+    return cart
+
+
+def get_live_cart(request, create=False):
+    token = request.session.get(CART_TOKEN_SESSION_KEY, '')
+    cart = load_live_cart(token) if token else None
+    if cart is None:
+        # Not in the store yet, or dropped from it: start from the saved cart if there is one
+        saved = find_cart(request)
+        if saved is not None:
+            cart = start_live_cart(saved)
+            if token != cart.token:
+                request.session[CART_TOKEN_SESSION_KEY] = cart.token
+        else:
+            cart = LiveCart(None, empty_state(request.user.pk))
+            if create:
+                materialize_cart(request, cart)
+    return cart
+
+
+def get_cart(request, create=False, with_lines=True):
+    if live_store_enabled():
+        return get_live_cart(request, create)
+    cart = find_cart(request, with_lines)
+    if cart is None:
+        # Empty in-memory placeholder, its lines resolve to an empty queryset without a query
+        cart = Cart()
+        if request.user.is_authenticated():
+            cart.owner = request.user
+        if create:
+            materialize_cart(request, cart)
+        return cart
+    remember_cart(request, cart)
+    return cart
+
+
+def get_request_cart(request, create=False, with_lines=True):
+    # Resolve the cart at most once per request, views and templates share it
+    if not hasattr(request, '_cached_cart'):
+        request._cached_cart = get_cart(request, create, with_lines)
+    elif create:
+        materialize_cart(request, request._cached_cart)
+    return request._cached_cart
+
+
+def amount_in_cart(cart, meal):
+    # Reads the prefetched lines, no extra query
+    for cart_meal in cart.cartmeal_set.all():
+        if cart_meal.meal_id == meal.pk:
+            return cart_meal.amount
+    return 0
+
+
+def _line(cart, link):
+    return CartMeal.objects.select_related('meal__subsec').filter(cart=cart, meal=link).first()
+
+
+def _add(cart, link):
+    # Increment in place, F() keeps concurrent clicks from losing each other's updates
+    if not CartMeal.objects.filter(cart=cart, meal=link).update(amount=F('amount') + 1):
+        price = Meal.objects.filter(link=link).values_list('price', flat=True).first()
+        if price is None:
+            return None
+        try:
+            with transaction.atomic():
+                CartMeal.objects.create(cart=cart, meal_id=link, amount=1, price=price)
+        except IntegrityError:
+            # Another request created the line first, (cart, meal) is unique
+            CartMeal.objects.filter(cart=cart, meal=link).update(amount=F('amount') + 1)
+    cart_meal = _line(cart, link)
+    Cart.objects.filter(pk=cart.pk).update(total_amount=F('total_amount') + 1,
+                                           total_price=F('total_price') + cart_meal.price,
+                                           version=F('version') + 1,
+                                           creation_date=timezone.now())
+    return cart_meal
+
+
+def _set(cart, link, amount):
+    price = Meal.objects.filter(link=link).values_list('price', flat=True).first()
+    if price is None:
+        raise ValueError('Unknown meal %r' % link)
+    if amount <= 0:
+        return _remove(cart, link)
+    if not CartMeal.objects.filter(cart=cart, meal=link).update(amount=amount):
+        try:
+            with transaction.atomic():
+                CartMeal.objects.create(cart=cart, meal_id=link, amount=amount, price=price)
+        except IntegrityError:
+            CartMeal.objects.filter(cart=cart, meal=link).update(amount=amount)
+    cart.update_totals()
+    return _line(cart, link)
+
+
+def _remove(cart, link):
+    if CartMeal.objects.filter(cart=cart, meal=link).delete()[0]:
+        cart.update_totals()
+    return None
+
+
+def _apply(cart, operation):
+    req_type, link = operation.get('type'), operation.get('meal')
+    if req_type == 'add':
+        return _add(cart, link)
+    if req_type == 'set':
+        return _set(cart, link, set_amount(operation))
+    if req_type == 'del':
+        return _remove(cart, link)
+    raise ValueError('Unknown cart operation %r' % req_type)
+
+
+def change_cart(cart, operation):
+    """
+    Applies one {'type': 'add'|'set'|'del', 'meal': link, 'amount': n} operation to a saved or live cart
+    in a single transaction. Returns the changed line with its meal loaded, or None when the line
+    is gone or the meal to add does not exist. Raises ValueError for a malformed operation, a set
+    without an amount or of an unknown meal, and CartLocked when another request kept a live cart locked.
+    """
+    return change_cart_batch(cart, [operation])[0]
+
+
+def change_cart_batch(cart, operations):
+    # All operations succeed or fail together
+    if isinstance(cart, LiveCart):
+        return change_live_cart(cart, operations)
+    return _change_saved_cart(cart, operations)
+
+
+@serialized_write
+def _change_saved_cart(cart, operations):
+    return [_apply(cart, operation) for operation in operations]
+
+
+def adopt_cart(request, user, only_filled=False):
+    """Gives the cart of the visitor to the user who is logging in or registering"""
+    if live_store_enabled():
+        cart = get_live_cart(request)
+        if cart.token is not None and (cart.total_amount or not only_filled):
+            save_live_cart(cart, owner=user)
+        return
+    cart = find_cart(request)
+    if cart is not None and (cart.cartmeal_set.all() or not only_filled):
+        cart.owner = user
+        cart.save()
+
+
+def save_request_cart(request):
+    # A live cart gets its rows before checkout looks for them
+    if live_store_enabled():
+        cart = get_live_cart(request)
+        if cart.token is not None:
+            save_live_cart(cart, owner=request.user if request.user.is_authenticated() else None)
+
+
+def cart_etag(cart):
+    # A placeholder cart has no id, every empty cart looks the same
+    return 'cart-%s-%s' % (cart.pk or 0, cart.version)
+
+
+def line_json(cart_meal):
+    meal = cart_meal.meal
+    return {
+        'meal': meal.link,
+        'title': str(meal),
+        'url': reverse('meal', args=(meal.subsec.sec_id, meal.subsec_id, meal.link)),
+        'amount': cart_meal.amount,
+        'price': cart_meal.price,
+        'sum': cart_meal.sum(),
+    }
+
+
+def cart_json(cart, lines):
+    return {
+        'version': cart.version,
+        # What ?version= of /cart/ takes, the version alone repeats in the next cart after checkout
+        'etag': cart_etag(cart),
+        'total_amount': cart.total_amount,
+        'total_price': cart.total_price,
+        'lines': lines,
+    }
@@ -0,0 +1,364 @@
+"""
+Write-behind store for open carts, switched on with CART_STORE = 'cache'. The live cart is a small dict
+in the CART_STORE_CACHE cache, keyed by the cart token of the session. Cart and CartMeal rows are
+written only at checkout, when the cart is given to a user who logs in, and by the batched flush
+every worker runs every CART_STORE_FLUSH_INTERVAL seconds. Changed carts stay in the cache until they
+are written, saved ones for CART_STORE_TIMEOUT seconds, after that they are loaded from the database again.
+"""
+import atexit
+import copy
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager, ExitStack
+from datetime import datetime
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.db import DatabaseCache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils import timezone
+
+from pizza_shop.database import serialized_write
+from pizza_shop.models import Cart, CartMeal, generate_token
+from pizza_shop.snapshot import RecordList, catalog_snapshot
+
+logger = logging.getLogger('pizza_shop.cartstore')
+
+STATE_KEY = 'cartstore:%s'
+LOCK_KEY = 'cartstore:lock:%s'
+LOCK_TIMEOUT = 5
+
+
+class CartLocked(Exception):
+    """Another request held the cart for LOCK_TIMEOUT seconds, the change was not made"""
+
+
+def live_store_enabled():
+    return getattr(settings, 'CART_STORE', 'db') == 'cache'
+
+
+def cart_cache():
+    return caches[getattr(settings, 'CART_STORE_CACHE', 'default')]
+
+
+def check_cart_cache(app_configs=None, **kwargs):
+    """The live carts need a cache that all workers share and that never drops an entry to make room"""
+    if not live_store_enabled():
+        return []
+    alias = getattr(settings, 'CART_STORE_CACHE', 'default')
+    cache = caches[alias]
+    if isinstance(cache, LocMemCache):
+        problem = 'keeps its entries per process, each worker would see different carts'
+    elif isinstance(cache, (FileBasedCache, DatabaseCache)):
+        problem = 'culls entries at MAX_ENTRIES, carts that are not written yet would be lost'
+    elif isinstance(cache, DummyCache):
+        problem = 'keeps nothing'
+    else:
+        return []
+    return [checks.Error(
+        "CART_STORE = 'cache' cannot use the %r cache, %s backend %s." % (alias, type(cache).__name__, problem),
+        hint="Point CART_STORE_CACHE at a shared memcached or redis cache that does not evict, "
+             "or set CART_STORE = 'db'.",
+        id='pizza_shop.E001',
+    )]
+
+
+def empty_state(owner_id=None):
+    return {
+        # Stands in for the primary key in fragment keys and ETags, the token stays private
+        'id': uuid.uuid4().hex,
+        'cart_id': None,
+        'owner_id': owner_id,
+        'version': 0,
+        'changed': time.time(),
+        # [meal link, amount, price] in the order the meals were put in
+        'lines': [],
+        'dirty': False,
+    }
+
+
+class LiveLine(object):
+    """A line of a live cart, what templates and line_json() use of a CartMeal"""
+    __slots__ = ('meal', 'amount', 'price')
+
+    def __init__(self, meal, amount, price):
+        self.meal = meal
+        self.amount = amount
+        self.price = price
+
+    @property
+    def meal_id(self):
+        return self.meal.link
+
+    def sum(self):
+        return self.amount * self.price
+
+    def __str__(self):
+        return str(self.meal)
+
+
+class LineList(RecordList):
+
+    def select_related(self, *fields):
+        # The meals come from the catalog snapshot, there is nothing to join
+        return self
+
+
+class LiveCart(object):
+    """
+    An open cart in the store, looks like a Cart with prefetched lines to templates and views.
+    token is None until something is put into the cart.
+    """
+
+    def __init__(self, token, state):
+        self.token = token
+        self.state = state
+        self._lines = None
+
+    @property
+    def pk(self):
+        return 'live-%s' % self.state['id'] if self.token else None
+
+    @property
+    def version(self):
+        return self.state['version']
+
+    @property
+    def owner_id(self):
+        return self.state['owner_id']
+
+    @property
+    def creation_date(self):
+        return datetime.fromtimestamp(self.state['changed'], timezone.utc)
+
+    @property
+    def cartmeal_set(self):
+        if self._lines is None:
+            meals = catalog_snapshot().meals
+            # Meals removed from the catalog drop out of the cart
+            self._lines = LineList(LiveLine(meals[link], amount, price)
+                                   for link, amount, price in self.state['lines'] if link in meals)
+        return self._lines
+
+    @property
+    def total_amount(self):
+        return sum(line.amount for line in self.cartmeal_set)
+
+    @property
+    def total_price(self):
+        return sum(line.sum() for line in self.cartmeal_set)
+
+    def refresh_from_db(self, **kwargs):
+        # The store is the current state, there is nothing to reload
+        pass
+
+    def update(self, state):
+        self.state = state
+        self._lines = None
+
+
+def load_live_cart(token):
+    state = cart_cache().get(STATE_KEY % token)
+    return LiveCart(token, state) if state is not None else None
+
+
+def store_state(token, state):
+    # A changed cart exists nowhere else, a saved one can be loaded from its rows again
+    timeout = None if state['dirty'] else getattr(settings, 'CART_STORE_TIMEOUT', 3600)
+    cart_cache().set(STATE_KEY % token, state, timeout)
+
+
+def start_live_cart(cart=None, owner_id=None):
+    """A new cart in the store, or the store's copy of a saved Cart"""
+    state = empty_state(owner_id)
+    if cart is None:
+        token = generate_token()
+    else:
+        token = cart.token
+        state.update(cart_id=cart.pk, owner_id=cart.owner_id, version=cart.version, lines=[
+            [line.meal_id, line.amount, line.price] for line in cart.cartmeal_set.all()])
+    store_state(token, state)
+    return LiveCart(token, state)
+
+
+@contextmanager
+def cart_lock(token):
+    # Clicks of one visitor may reach several workers at once, the cache add is the lock. Its value tells
+    # the holder from a request that took the lock over once it expired.
+    cache, key, holder = cart_cache(), LOCK_KEY % token, uuid.uuid4().hex
+    deadline = time.time() + LOCK_TIMEOUT
+    while not cache.add(key, holder, LOCK_TIMEOUT):
+        if time.time() >= deadline:
+            raise CartLocked('The cart stayed locked for %s seconds' % LOCK_TIMEOUT)
+        time.sleep(0.005)
+    try:
+        yield
+    finally:
+        # The cache API has no delete-if-equal, the window between the two calls is left open
+        if cache.get(key) == holder:
+            cache.delete(key)
+
+
+def set_amount(operation):
+    # A set without an amount changes nothing, it must not be taken for a zero that empties the line
+    amount = operation.get('amount')
+    if amount is None or amount == '':
+        raise ValueError('A set operation needs an amount')
+    return int(amount)
+
+
+def _apply(state, operation):
+    req_type, link = operation.get('type'), operation.get('meal')
+    if req_type not in ('add', 'set', 'del'):
+        raise ValueError('Unknown cart operation %r' % req_type)
+    lines = state['lines']
+    line = next((line for line in lines if line[0] == link), None)
+    if req_type == 'del':
+        return _remove_line(state, line)
+
+    meal = catalog_snapshot().meals.get(link)
+    if req_type == 'add':
+        if meal is None:
+            return None
+        amount = line[1] + 1 if line is not None else 1
+    else:
+        amount = set_amount(operation)
+        if meal is None:
+            raise ValueError('Unknown meal %r' % link)
+        if amount <= 0:
+            return _remove_line(state, line)
+    if line is None:
+        line = [link, 0, meal.price]
+        lines.append(line)
+    line[1] = amount
+    state['version'] += 1
+    return LiveLine(meal, line[1], line[2])
+
+
+def _remove_line(state, line):
+    if line is not None:
+        state['lines'].remove(line)
+        state['version'] += 1
+    return None
+
+
+def change_live_cart(cart, operations):
+    """Same operations and results as cart.change_cart_batch, all or nothing, without a database write"""
+    with cart_lock(cart.token):
+        current = cart_cache().get(STATE_KEY % cart.token) or cart.state
+        state = copy.deepcopy(current)
+        results = [_apply(state, operation) for operation in operations]
+        if state['version'] != current['version']:
+            state['changed'] = time.time()
+            state['dirty'] = True
+            store_state(cart.token, state)
+    cart.update(state)
+    if state['dirty']:
+        mark_dirty(cart.token)
+    maybe_flush()
+    return results
+
+
+def _save_states(items):
+    # One transaction for the whole batch: the carts, then all their lines in two queries
+    saved = Cart.objects.in_bulk([state['cart_id'] for token, state in items if state['cart_id']])
+    meals = catalog_snapshot().meals
+    lines = []
+    for token, state in items:
+        state_lines = [(link, amount, price) for link, amount, price in state['lines'] if link in meals]
+        cart = saved.get(state['cart_id'])
+        if cart is None or cart.archive:
+            if not state_lines:
+                # An emptied cart that never had a row needs none
+                state['dirty'] = False
+                continue
+            cart = Cart(token=token)
+        cart.owner_id = state['owner_id']
+        cart.version = state['version']
+        cart.total_amount = sum(amount for link, amount, price in state_lines)
+        cart.total_price = sum(amount * price for link, amount, price in state_lines)
+        cart.save()
+        state['cart_id'] = cart.pk
+        state['dirty'] = False
+        lines.extend(CartMeal(cart_id=cart.pk, meal_id=link, amount=amount, price=price)
+                     for link, amount, price in state_lines)
+    CartMeal.objects.filter(cart_id__in=[state['cart_id'] for token, state in items if state['cart_id']]).delete()
+    CartMeal.objects.bulk_create(lines)
+
+
+save_states = serialized_write(_save_states)
+
+
+def save_live_cart(cart, owner=None):
+    """Writes a live cart to Cart/CartMeal now, giving it to owner if one is passed. Returns the Cart id."""
+    with cart_lock(cart.token):
+        state = cart_cache().get(STATE_KEY % cart.token) or cart.state
+        if owner is not None:
+            state['owner_id'] = owner.pk
+        save_states([(cart.token, state)])
+        store_state(cart.token, state)
+    cart.update(state)
+    with _dirty_lock:
+        _dirty.discard(cart.token)
+    return state['cart_id']
+
+
+def discard_live_cart(token):
+    cart_cache().delete(STATE_KEY % token)
+    with _dirty_lock:
+        _dirty.discard(token)
+
+
+# Tokens of the carts this worker changed since its last flush
+_dirty = set()
+_dirty_lock = threading.Lock()
+_last_flush = time.time()
+
+
+def mark_dirty(token):
+    with _dirty_lock:
+        _dirty.add(token)
+
+
+def maybe_flush():
+    if time.time() - _last_flush >= getattr(settings, 'CART_STORE_FLUSH_INTERVAL', 60):
+        flush_live_carts()
+
+
+def flush_live_carts():
+    """Writes the carts this worker changed to the database in one transaction, returns how many"""
+    global _last_flush
+    with _dirty_lock:
+        tokens = sorted(_dirty)
+        _dirty.clear()
+        _last_flush = time.time()
+    if not tokens:
+        return 0
+    try:
+        with ExitStack() as locks:
+            for token in tokens:
+                locks.enter_context(cart_lock(token))
+            items = [(token, cart_cache().get(STATE_KEY % token)) for token in tokens]
+            # Gone when the cart was ordered or discarded meanwhile, clean when another worker saved it
+            items = [(token, state) for token, state in items if state is not None and state['dirty']]
+            if items:
+                save_states(items)
+                for token, state in items:
+                    store_state(token, state)
+    except Exception:
+        logger.exception('Flushing %d live carts failed, they are kept for the next flush', len(tokens))
+        with _dirty_lock:
+            _dirty.update(tokens)
+        return 0
+    return len(items)
+
+
+@atexit.register
+def _flush_at_exit():
+    if live_store_enabled():
+        flush_live_carts()
@@ -0,0 +1,35 @@
+import time
+
+from django.core.cache import cache
+
+CATALOG_VERSION_KEY = 'pizza_shop:catalog_version'
+# Versions bumped by other processes are noticed after this many seconds, own bumps at once
+CATALOG_VERSION_TTL = 1
+
+_version = (None, 0)
+
+
+def catalog_version():
+    """
+    Changes whenever a section, subsection, meal, image or ingredient is saved or deleted.
+    Kept in the Django cache so every worker sees the same value.
+    """
+    global _version
+    version, fetched_at = _version
+    now = time.time()
+    if version is None or now - fetched_at > CATALOG_VERSION_TTL:
+        version = cache.get(CATALOG_VERSION_KEY)
+        if version is None:
+            cache.add(CATALOG_VERSION_KEY, int(now * 1000), None)
+            version = cache.get(CATALOG_VERSION_KEY, int(now * 1000))
+        _version = (version, now)
+    return version
+
+
+def bump_catalog_version():
+    global _version
+    # A millisecond stamp survives a cache restart without going back to an old value
+    version = max(int(time.time() * 1000), (cache.get(CATALOG_VERSION_KEY) or 0) + 1)
+    cache.set(CATALOG_VERSION_KEY, version, None)
+    _version = (version, time.time())
+    return version
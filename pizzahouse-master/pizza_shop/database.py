@@ -0,0 +1,48 @@
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection, transaction, OperationalError
+
+# Threads of a worker wait for each other here instead of polling SQLite's lock
+_write_lock = threading.Lock()
+
+
+# SQLITE_BUSY and SQLITE_LOCKED, the latter may name the table after a colon
+LOCKED_MESSAGES = ('database is locked', 'database table is locked')
+
+
+def is_locked(error):
+    return str(error).startswith(LOCKED_MESSAGES)
+
+
+def serialized_write(func):
+    """
+    Runs func in one short write transaction: one writer per process at a time, the database
+    write lock taken at BEGIN and the whole transaction retried when the database stays locked
+    past the busy timeout. Inside an outer transaction func gets a savepoint.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if connection.in_atomic_block:
+            # A savepoint in the outer transaction, whoever opened that one retries
+            with transaction.atomic():
+                return func(*args, **kwargs)
+        retries = getattr(settings, 'WRITE_RETRIES', 3)
+        delay = getattr(settings, 'WRITE_RETRY_DELAY', 0.05)
+        for attempt in range(retries + 1):
+            try:
+                with _write_lock:
+                    connection.begin_immediate = True
+                    try:
+                        with transaction.atomic():
+                            return func(*args, **kwargs)
+                    finally:
+                        connection.begin_immediate = False
+            except OperationalError as e:
+                if attempt == retries or not is_locked(e):
+                    raise
+            # Back off outside the lock so the other threads get their turn
+            time.sleep(delay * 2 ** attempt)
+    return wrapper
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULT_BACKEND = {
+    'BACKEND': 'pizza_shop.fragments.LocMemLRUCache',
+    'OPTIONS': {'max_entries': 5000},
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+class LocMemLRUCache(object):
+    """Rendered fragments of this process, the least recently used ones are dropped first"""
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FileLRUCache(object):
+    """
+    Fragments as files in one directory, shared by all workers of a host. The modification
+    time is the last use, the oldest files are removed when there are more than max_entries.
+    Each process counts the files it adds to the last listing it made, so the directory is only
+    listed when that count passes the limit. Files of the other workers are seen at that listing.
+    """
+
+    def __init__(self, location, max_entries=5000):
+        self.location = location
+        self.max_entries = max_entries
+        os.makedirs(location, exist_ok=True)
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.location, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.html')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read().decode('utf-8')
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return value
+
+    def set(self, key, value):
+        path = self.path(key)
+        added = not os.path.exists(path)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(value.encode('utf-8'))
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._entries is not None and added:
+                self._entries += 1
+            full = self._entries is None or self._entries > self.max_entries
+        if full:
+            self.cull()
+
+    def cull(self):
+        names = [name for name in os.listdir(self.location) if name.endswith('.html')]
+        self._entries = len(names)
+        if len(names) <= self.max_entries:
+            return
+        files = []
+        for name in names:
+            path = os.path.join(self.location, name)
+            try:
+                files.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        files.sort()
+        # Free a tenth at once so the directory is not listed again after a few more sets
+        removed = files[:len(files) - self.max_entries * 9 // 10]
+        for mtime, path in removed:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._entries = len(names) - len(removed)
+
+    def clear(self):
+        for name in os.listdir(self.location):
+            if name.endswith('.html'):
+                os.remove(os.path.join(self.location, name))
+        self._entries = 0
+
+
+def fragment_cache():
+    """The backend configured by settings.FRAGMENT_CACHE, created on first use"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                config = getattr(settings, 'FRAGMENT_CACHE', DEFAULT_BACKEND)
+                _backend = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+    return _backend
+
+
+def reset_fragment_cache():
+    global _backend
+    _backend = None
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from pizza_shop.fragments import LocMemLRUCache
+
+# name: (width, height, crop). Without crop the image is scaled to fit into the box keeping proportions
+SIZES = {
+    'card': (320, 150, False),
+    'card2x': (640, 300, False),
+    'admin': (100, 100, True),
+    'large': (800, 600, False),
+}
+FORMATS = {
+    'jpeg': ('jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'webp': ('webp', {'quality': 80, 'method': 4}),
+}
+DERIVED_DIR = 'derived'
+
+_executor = None
+_executor_lock = threading.Lock()
+# (media root, digest) of the images whose derivatives are all on disk, they are not checked again
+_ready = LocMemLRUCache(max_entries=10000)
+
+
+def file_digest(field_file):
+    """sha1 of the image bytes, derivatives are stored under it so equal uploads share them"""
+    sha = hashlib.sha1()
+    # chunks() rewinds the file first, rewind again so a fresh upload can still be saved afterwards
+    for chunk in field_file.chunks():
+        sha.update(chunk)
+    field_file.seek(0)
+    return sha.hexdigest()
+
+
+def derivative_name(digest, size, fmt='jpeg'):
+    # MEDIA_ROOT/derived/ab/ab12..._320x150.jpg, two letter buckets keep directories small
+    width, height, crop = SIZES[size]
+    return '{0}/{1}/{2}_{3}x{4}.{5}'.format(DERIVED_DIR, digest[:2], digest, width, height, FORMATS[fmt][0])
+
+
+def ready_marker_name(digest):
+    # Empty file written after all derivatives of the image
+    return '{0}/{1}/{2}.ready'.format(DERIVED_DIR, digest[:2], digest)
+
+
+def render_derivatives(src_path, digest, media_root, force=False):
+    """
+    Writes every size and format of one image, then the ready marker. Runs in worker threads
+    and processes, so it only touches Pillow and the file system. Returns the names of the written files.
+    """
+    from PIL import Image, ImageOps
+
+    written = []
+    with Image.open(src_path) as source:
+        source = ImageOps.exif_transpose(source).convert('RGB')
+        for size, (width, height, crop) in SIZES.items():
+            if crop:
+                resized = ImageOps.fit(source, (width, height), Image.LANCZOS)
+            else:
+                resized = source.copy()
+                resized.thumbnail((width, height), Image.LANCZOS)
+            for fmt, (ext, options) in FORMATS.items():
+                name = derivative_name(digest, size, fmt)
+                path = os.path.join(media_root, name)
+                if not force and os.path.exists(path):
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write next to the target and rename, readers never see a half written file
+                tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+                resized.save(tmp_path, fmt.upper(), **options)
+                os.replace(tmp_path, path)
+                written.append(name)
+    marker = os.path.join(media_root, ready_marker_name(digest))
+    if not os.path.exists(marker):
+        open(marker, 'wb').close()
+    return written
+
+
+def get_executor():
+    # Threads, not processes: forking a threaded web worker copies locks other threads hold.
+    # Pillow releases the GIL while it resizes and encodes.
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'THUMBNAIL_WORKERS', 2))
+    return _executor
+
+
+def schedule_derivatives(image, force=False):
+    """Queues the derivatives of a MealImage, the request does not wait for them"""
+    if not image.digest:
+        return None
+    storage = image.img.storage
+    args = (image.img.path, image.digest, storage.location, force)
+    if not getattr(settings, 'THUMBNAIL_WORKERS', 2):
+        return render_derivatives(*args)
+    return get_executor().submit(render_derivatives, *args)
+
+
+def derivatives_ready(image):
+    """True once every derivative of the image is written, the storage is asked once per image and process"""
+    storage = image.img.storage
+    key = (storage.location, image.digest)
+    if _ready.get(key):
+        return True
+    if not storage.exists(ready_marker_name(image.digest)):
+        return False
+    _ready.set(key, True)
+    return True
+
+
+def derivative_url(image, size, fmt='jpeg'):
+    """Url of a derivative, None while they are not generated yet"""
+    if image is None or not image.digest or not derivatives_ready(image):
+        return None
+    return image.img.storage.url(derivative_name(image.digest, size, fmt))
+
+
+def picture_sources(image, size, retina_size=None):
+    """
+    Context for a <picture> element: WebP and JPEG srcsets when the derivatives exist,
+    the original image otherwise.
+    """
+    if image is None:
+        return {'src': '', 'srcset': '', 'webp_srcset': ''}
+    sources = {}
+    for fmt in FORMATS:
+        urls = [derivative_url(image, size, fmt)]
+        if retina_size:
+            urls.append(derivative_url(image, retina_size, fmt))
+        sources[fmt] = urls
+    jpeg, webp = sources['jpeg'], sources['webp']
+    return {
+        'src': jpeg[0] or image.img.url,
+        'srcset': ', '.join('%s %dx' % (url, n) for n, url in enumerate(jpeg, 1) if url) if jpeg[0] else '',
+        'webp_srcset': ', '.join('%s %dx' % (url, n) for n, url in enumerate(webp, 1) if url) if webp[0] else '',
+    }
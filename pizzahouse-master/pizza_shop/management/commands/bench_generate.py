@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from pizza_shop.benchmark import SCALES, generate_dataset, clear_dataset
+
+
+class Command(BaseCommand):
+    help = 'Fills the database with a seeded synthetic catalog, users and carts for bench_run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=sorted(SCALES), default='small',
+                            help='Preset sizes, the options below override single values')
+        parser.add_argument('--seed', type=int, default=1)
+        for name, help_text in (('sections', 'Number of sections'),
+                                ('subsections', 'Subsections per section'),
+                                ('meals', 'Meals per subsection'),
+                                ('images', 'Images per meal'),
+                                ('ingredients', 'Number of ingredients'),
+                                ('users', 'Number of users'),
+                                ('carts', 'Number of carts, open ones and orders'),
+                                ('lines', 'Lines per cart')):
+            parser.add_argument('--' + name, type=int, default=None, help=help_text)
+        parser.add_argument('--clear', action='store_true', default=False,
+                            help='Remove the data of a previous run first')
+
+    def handle(self, *args, **options):
+        sizes = dict(SCALES[options['scale']])
+        for name in sizes:
+            if options[name] is not None:
+                sizes[name] = options[name]
+        if options['clear']:
+            clear_dataset()
+            self.stdout.write('Previous benchmark data removed')
+        self.stdout.write('Generating %s' % ', '.join('%s=%d' % item for item in sorted(sizes.items())))
+        generate_dataset(seed=options['seed'], log=self.stdout.write, **sizes)
+        self.stdout.write(self.style.SUCCESS('Done'))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from pizza_shop.benchmark import SCENARIOS, run_benchmark, save_report, load_report, compare_reports, summarize
+
+
+class Command(BaseCommand):
+    help = 'Drives the views with concurrent test clients and reports throughput, latency and query counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default=','.join(sorted(SCENARIOS)),
+                            help='Comma separated, of: %s' % ', '.join(sorted(SCENARIOS)))
+        parser.add_argument('--clients', type=int, default=4, help='Concurrent clients per scenario')
+        parser.add_argument('--requests', type=int, default=100, help='Measured requests per client')
+        parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests per client')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--background', choices=sorted(SCENARIOS),
+                            help='Scenario run by more clients while each scenario is measured, e.g. cart')
+        parser.add_argument('--background-clients', type=int, default=2)
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--compare', help='JSON results of an earlier run, fail on regressions')
+        parser.add_argument('--threshold', type=float, default=20,
+                            help='Allowed p95 and throughput change against --compare, in percent')
+
+    def handle(self, *args, **options):
+        scenarios = [name.strip() for name in options['scenarios'].split(',') if name.strip()]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError('Unknown scenarios: %s' % ', '.join(sorted(unknown)))
+        try:
+            report = run_benchmark(scenarios, clients=options['clients'], requests=options['requests'],
+                                   warmup=options['warmup'], seed=options['seed'], background=options['background'],
+                                   background_clients=options['background_clients'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        for line in summarize(report):
+            self.stdout.write(line)
+
+        if options['output']:
+            save_report(options['output'], report, dict((name, options[name]) for name in (
+                'scenarios', 'clients', 'requests', 'warmup', 'seed', 'background', 'background_clients')))
+            self.stdout.write('Results written to %s' % options['output'])
+        if options['compare']:
+            regressions = compare_reports(load_report(options['compare']), report, options['threshold'])
+            if regressions:
+                raise CommandError('Regressions against %s:\n%s' % (options['compare'], '\n'.join(regressions)))
+            self.stdout.write(self.style.SUCCESS('No regressions against %s' % options['compare']))
@@ -0,0 +1,57 @@
+import os
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from pizza_shop.assets import COMPRESSIBLE
+
+
+def unminified_duplicates():
+    """bootstrap.css when bootstrap.min.css is next to it, templates only ever link the minified one"""
+    paths = set()
+    for finder in finders.get_finders():
+        for path, storage in finder.list([]):
+            paths.add(path.replace(os.sep, '/'))
+    duplicated, needed = set(), set()
+    for path in paths:
+        root, ext = os.path.splitext(path)
+        if root.endswith('.min'):
+            continue
+        # collectstatic matches ignore patterns against base names only, keep a name if any copy lacks a .min
+        if root + '.min' + ext in paths:
+            duplicated.add(os.path.basename(path))
+        else:
+            needed.add(os.path.basename(path))
+    return sorted(duplicated - needed)
+
+
+class Command(BaseCommand):
+    help = 'Collects static files into STATIC_ROOT with hashed names and precompressed copies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-unminified', action='store_true', default=False,
+                            help='Also collect files that have a .min version')
+
+    def handle(self, *args, **options):
+        ignore = [] if options['keep_unminified'] else unminified_duplicates()
+        for name in ignore:
+            self.stdout.write('Skipping %s, a minified version exists' % name)
+        call_command('collectstatic', interactive=False, clear=True, ignore_patterns=ignore,
+                     verbosity=max(options['verbosity'] - 1, 0), stdout=self.stdout)
+
+        original = compressed = 0
+        staticfiles_storage.hashed_files = staticfiles_storage.load_manifest()
+        for name in staticfiles_storage.hashed_files.values():
+            if not name.endswith(COMPRESSIBLE):
+                continue
+            path = os.path.join(settings.STATIC_ROOT, name)
+            size = os.path.getsize(path)
+            original += size
+            compressed += min([os.path.getsize(path + suffix) for suffix in ('.br', '.gz')
+                               if os.path.exists(path + suffix)] or [size])
+        self.stdout.write(self.style.SUCCESS('Done, %d files in %s, text assets %d KB, compressed %d KB'
+                                             % (len(staticfiles_storage.hashed_files), settings.STATIC_ROOT,
+                                                original // 1024, compressed // 1024)))
@@ -0,0 +1,43 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from pizza_shop.images import file_digest, render_derivatives
+from pizza_shop.models import MealImage
+
+
+class Command(BaseCommand):
+    help = 'Builds the thumbnails and WebP variants of all meal images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of worker processes, the CPU count by default')
+        parser.add_argument('--force', action='store_true', default=False,
+                            help='Rebuild derivatives that already exist')
+
+    def handle(self, *args, **options):
+        jobs = []
+        for image in MealImage.objects.order_by('id').iterator():
+            storage = image.img.storage
+            if not image.img or not storage.exists(image.img.name):
+                self.stderr.write('%s: file %s is missing' % (image, image.img.name))
+                continue
+            if not image.digest or options['force']:
+                with storage.open(image.img.name, 'rb') as f:
+                    digest = file_digest(f)
+                if digest != image.digest:
+                    MealImage.objects.filter(pk=image.pk).update(digest=digest)
+                    image.digest = digest
+            jobs.append((str(image), (image.img.path, image.digest, storage.location, options['force'])))
+
+        written = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = [(title, executor.submit(render_derivatives, *args)) for title, args in jobs]
+            for title, future in futures:
+                try:
+                    written += len(future.result())
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write('%s: %s' % (title, e))
+        self.stdout.write(self.style.SUCCESS('Done, %d images, %d files written, %d failed'
+                                             % (len(jobs), written, failed)))
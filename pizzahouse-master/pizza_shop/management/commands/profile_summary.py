@@ -0,0 +1,50 @@
+import glob
+import os
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pizza_shop.profiling import profile_dir, profile_token, read_collapsed, stack_category
+
+
+class Command(BaseCommand):
+    help = 'Summarizes the collapsed stack profiles written by ProfilingMiddleware'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=None, help='Profile directory, settings.PROFILE_DIR by default')
+        parser.add_argument('--view', action='append', default=[], help='Only these views, may be repeated')
+        parser.add_argument('--top', type=int, default=20, help='Number of hot paths to show')
+        parser.add_argument('--depth', type=int, default=3, help='Frames from the leaf that make up a path')
+        parser.add_argument('--token', action='store_true', default=False,
+                            help='Print a value for the X-Profile request header and exit')
+
+    def handle(self, *args, **options):
+        if options['token']:
+            self.stdout.write(profile_token())
+            return
+
+        directory = options['dir'] or profile_dir()
+        profiles = {}
+        for path in sorted(glob.glob(os.path.join(directory, '*.collapsed'))):
+            view = os.path.basename(path)[:-len('.collapsed')]
+            if not options['view'] or view in options['view']:
+                profiles[view] = read_collapsed(path)
+        if not profiles:
+            raise CommandError('No profiles in %s' % directory)
+
+        self.stdout.write('%-30s %8s %6s %9s %7s' % ('view', 'samples', 'orm', 'template', 'python'))
+        paths = Counter()
+        for view, stacks in sorted(profiles.items(), key=lambda item: -sum(item[1].values())):
+            total = sum(stacks.values())
+            categories = Counter()
+            for stack, count in stacks.items():
+                categories[stack_category(stack)] += count
+                paths[';'.join(stack.split(';')[-options['depth']:])] += count
+            self.stdout.write('%-30s %8d %5d%% %8d%% %6d%%' % (
+                view, total, 100 * categories['orm'] // total, 100 * categories['template'] // total,
+                100 * categories['python'] // total))
+
+        total = sum(paths.values())
+        self.stdout.write('\nHot paths, leaf last:')
+        for path, count in paths.most_common(options['top']):
+            self.stdout.write('%6d %5.1f%%  %s' % (count, 100.0 * count / total, path.replace(';', ' > ')))
@@ -0,0 +1,41 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from pizza_shop.models import Cart
+
+
+class Command(BaseCommand):
+    help = 'Deletes open carts that are empty or have not been touched for a long time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30,
+                            help='Open carts not modified for this many days are stale')
+        parser.add_argument('--empty-minutes', type=int, default=60,
+                            help='Empty carts younger than this are kept, they may be filled right now')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of carts deleted per query')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only count the carts that would be deleted')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        stale = Q(creation_date__lt=now - timedelta(days=options['days']))
+        empty = Q(cartmeal__isnull=True, creation_date__lt=now - timedelta(minutes=options['empty_minutes']))
+        carts = Cart.objects.filter(archive=False).filter(stale | empty).order_by()
+
+        if options['dry_run']:
+            self.stdout.write('%d carts would be deleted' % carts.values('id').distinct().count())
+            return
+
+        deleted = 0
+        while True:
+            ids = list(carts.values_list('id', flat=True).distinct()[:options['chunk_size']])
+            if not ids:
+                break
+            Cart.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+            self.stdout.write('%d carts deleted' % deleted)
+        self.stdout.write(self.style.SUCCESS('Done, %d carts deleted' % deleted))
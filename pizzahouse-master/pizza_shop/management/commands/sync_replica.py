@@ -0,0 +1,38 @@
+import os
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from pizza_shop.routers import REPLICA
+
+
+class Command(BaseCommand):
+    help = 'Refreshes the read-only catalog replica from the primary database, run it from cron'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=None,
+                            help='Replica file, settings.CATALOG_REPLICA or the replica database by default')
+
+    def handle(self, *args, **options):
+        primary = connections[DEFAULT_DB_ALIAS]
+        if primary.vendor != 'sqlite':
+            raise CommandError('The replica stand-in is a copy of an SQLite primary')
+        path = options['path'] or (settings.DATABASES[REPLICA]['NAME'] if REPLICA in settings.DATABASES
+                                   else settings.CATALOG_REPLICA)
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        # A consistent copy from one read transaction, writers of the primary are not held up
+        with primary.cursor() as cursor:
+            cursor.execute('VACUUM INTO %s', [tmp_path])
+        # Readers open the replica query only, in WAL mode they would need to write its -shm file
+        copy = sqlite3.connect(tmp_path)
+        copy.execute('PRAGMA journal_mode = DELETE')
+        copy.close()
+        # Open replica connections keep reading the old file until they are closed, at the end of their request
+        os.replace(tmp_path, path)
+        # The catalog snapshot and search index are built from the primary, nothing cached needs dropping
+        self.stdout.write(self.style.SUCCESS('Replica %s refreshed' % path))
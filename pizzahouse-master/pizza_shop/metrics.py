@@ -0,0 +1,209 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import islice
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, Http404
+from django.template.backends.django import Template
+from django.utils.crypto import constant_time_compare
+
+logger = logging.getLogger('pizza_shop.metrics')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576)
+# Types of the ajax handler with a label of their own, whatever else a client posts is counted as 'other'
+HANDLER_TYPES = frozenset(('add', 'set', 'del', 'batch', 'search'))
+
+
+def label_value(value):
+    """A label value of the text format, with backslashes, double quotes and newlines escaped"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram(object):
+    """Cumulative buckets in the Prometheus style, le is the upper bound of a bucket"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            cumulative += count
+            yield '%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative)
+        yield '%s_sum{%s} %s' % (name, labels, self.sum)
+        yield '%s_count{%s} %d' % (name, labels, self.count)
+
+
+class RequestMetrics(object):
+    """Per view histograms of this process"""
+
+    HISTOGRAMS = (
+        ('pizza_request_seconds', LATENCY_BUCKETS),
+        ('pizza_request_queries', QUERY_BUCKETS),
+        ('pizza_request_query_seconds', LATENCY_BUCKETS),
+        ('pizza_request_template_seconds', LATENCY_BUCKETS),
+        ('pizza_response_bytes', SIZE_BUCKETS),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.histograms = defaultdict(lambda: [Histogram(bounds) for name, bounds in self.HISTOGRAMS])
+        self.statuses = defaultdict(int)
+        self.over_budget = defaultdict(int)
+
+    def observe(self, view, status, values, over_budget=False):
+        with self._lock:
+            for histogram, value in zip(self.histograms[view], values):
+                # None when the value was not measured, queries without METRICS_QUERIES in production
+                if value is not None:
+                    histogram.observe(value)
+            self.statuses[view, status] += 1
+            if over_budget:
+                self.over_budget[view] += 1
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for index, (name, bounds) in enumerate(self.HISTOGRAMS):
+                lines.append('# TYPE %s histogram' % name)
+                for view in sorted(self.histograms):
+                    lines.extend(self.histograms[view][index].lines(name, 'view="%s"' % label_value(view)))
+            lines.append('# TYPE pizza_requests_total counter')
+            for (view, status), count in sorted(self.statuses.items()):
+                lines.append('pizza_requests_total{view="%s",status="%s"} %d' % (label_value(view), status, count))
+            lines.append('# TYPE pizza_requests_over_query_budget_total counter')
+            for view, count in sorted(self.over_budget.items()):
+                lines.append('pizza_requests_over_query_budget_total{view="%s"} %d' % (label_value(view), count))
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+# Functions returning more lines for /metrics/
+exporters = []
+
+_render_state = threading.local()
+
+
+def _timed_render(render):
+    def wrapper(self, *args, **kwargs):
+        # Templates rendered from inside another template (cart holes) are already counted
+        depth = getattr(_render_state, 'depth', 0)
+        _render_state.depth = depth + 1
+        start = time.time()
+        try:
+            return render(self, *args, **kwargs)
+        finally:
+            _render_state.depth = depth
+            if depth == 0:
+                _render_state.seconds = getattr(_render_state, 'seconds', 0) + time.time() - start
+    wrapper.timed = True
+    return wrapper
+
+
+def instrument_templates():
+    # Django 1.9 has no hook around template rendering, time the backend's render instead
+    if not getattr(Template.render, 'timed', False):
+        Template.render = _timed_render(Template.render)
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    name = match.url_name or match.func.__name__
+    if name == 'handler' and request.method == 'POST':
+        # The ajax handler does very different things depending on the type
+        req_type = request.POST.get('type', '')
+        name = 'handler:%s' % (req_type if req_type in HANDLER_TYPES else 'other')
+    return name
+
+
+class RequestMetricsMiddleware(object):
+    """
+    Records latency, ORM query count and time, template time and response size for every view.
+    Queries are taken from the connection query log. It is kept with DEBUG, METRICS_QUERIES switches
+    it on for every request otherwise, at the cost of formatting each statement.
+    """
+
+    def __init__(self):
+        instrument_templates()
+
+    def process_request(self, request):
+        request._metrics_start = time.time()
+        request._metrics_debug_cursor = {}
+        request._metrics_queries = {}
+        force = getattr(settings, 'METRICS_QUERIES', False)
+        for connection in connections.all():
+            request._metrics_debug_cursor[connection.alias] = connection.force_debug_cursor
+            if force and not connection.queries_logged:
+                # Nobody else reads the log, start empty so it never fills up to its maxlen
+                connection.queries_log.clear()
+                connection.force_debug_cursor = True
+            if connection.queries_logged:
+                request._metrics_queries[connection.alias] = len(connection.queries_log)
+        _render_state.depth = 0
+        _render_state.seconds = 0
+
+    def process_response(self, request, response):
+        start = getattr(request, '_metrics_start', None)
+        if start is None:
+            return response
+        latency = time.time() - start
+        queries = query_seconds = None
+        for connection in connections.all():
+            if connection.alias not in request._metrics_queries:
+                continue
+            log = list(islice(connection.queries_log, request._metrics_queries[connection.alias], None))
+            queries = (queries or 0) + len(log)
+            query_seconds = (query_seconds or 0.0) + sum(float(query['time']) for query in log)
+            connection.force_debug_cursor = request._metrics_debug_cursor[connection.alias]
+        template_seconds = getattr(_render_state, 'seconds', 0)
+        size = len(response.content) if not response.streaming else 0
+
+        view = view_name(request)
+        budget = getattr(settings, 'METRICS_QUERY_BUDGET', None)
+        over_budget = budget is not None and queries is not None and queries > budget
+        request_metrics.observe(view, response.status_code,
+                                (latency, queries, query_seconds, template_seconds, size), over_budget)
+        if over_budget:
+            logger.warning('%s %s made %d queries, the budget is %d', view, request.path, queries, budget)
+        if getattr(settings, 'METRICS_LOG', False):
+            logger.info('%s %s %d %.1fms queries=%s/%.1fms templates=%.1fms bytes=%d', view, request.path,
+                        response.status_code, latency * 1000, queries, (query_seconds or 0) * 1000,
+                        template_seconds * 1000, size)
+        return response
+
+
+def can_read_metrics(request):
+    # Behind a reverse proxy every request comes from the proxy's address, so that tells nothing
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if token and authorization.startswith('Bearer ') and constant_time_compare(authorization[7:], token):
+        return True
+    user = getattr(request, 'user', None)
+    return user is not None and user.is_active and user.is_staff
+
+
+def metrics(request):
+    """Prometheus text format, for scrapers sending METRICS_TOKEN as a bearer token and for staff users"""
+    if not can_read_metrics(request):
+        raise Http404
+    text = request_metrics.render() + ''.join(line + '\n' for export in exporters for line in export())
+    return HttpResponse(text, content_type='text/plain; version=0.0.4')
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 10:11
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pizza_shop', '0002_auto_20160617_1714'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='cart',
+            index_together=set([('owner', 'archive', 'creation_date'), ('token', 'archive')]),
+        ),
+    ]
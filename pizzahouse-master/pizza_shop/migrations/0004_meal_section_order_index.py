@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pizza_shop', '0003_cart_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='meal',
+            index_together=set([('subsec', 'add_date')]),
+        ),
+    ]
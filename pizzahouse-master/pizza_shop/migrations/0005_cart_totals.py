@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 10:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+
+def fill_totals(apps, schema_editor):
+    Cart = apps.get_model('pizza_shop', 'Cart')
+    CartMeal = apps.get_model('pizza_shop', 'CartMeal')
+    # Existing lines have no snapshot, the current meal price is the best we know
+    for cart_meal in CartMeal.objects.select_related('meal'):
+        CartMeal.objects.filter(pk=cart_meal.pk).update(price=cart_meal.meal.price)
+    totals = CartMeal.objects.values('cart').annotate(
+        total_amount=Sum('amount'),
+        total_price=Sum(F('amount') * F('price'), output_field=models.PositiveIntegerField()),
+    )
+    for row in totals:
+        Cart.objects.filter(pk=row['cart']).update(total_amount=row['total_amount'], total_price=row['total_price'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pizza_shop', '0004_meal_section_order_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='total_amount',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество блюд'),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='total_price',
+            field=models.PositiveIntegerField(default=0, verbose_name='Сумма заказа'),
+        ),
+        migrations.AddField(
+            model_name='cartmeal',
+            name='price',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='Цена'),
+        ),
+        migrations.RunPython(fill_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 10:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import pizza_shop.models
+
+STATES = (
+    ('Ожидается', 'Заказ не оформлен'),
+    ('Не оплачен', 'Оплатите заказ'),
+    ('Оплачено', 'Спасибо за покупку'),
+)
+
+
+def seed_states(apps, schema_editor):
+    State = apps.get_model('pizza_shop', 'State')
+    for text, details in STATES:
+        if not State.objects.filter(text=text).exists():
+            State.objects.create(text=text, details=details)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pizza_shop', '0005_cart_totals'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_states, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='cart',
+            name='status',
+            field=models.ForeignKey(default=pizza_shop.models.default_state, on_delete=django.db.models.deletion.CASCADE, related_name='carts', to='pizza_shop.State', verbose_name='Статус заказа'),
+        ),
+    ]
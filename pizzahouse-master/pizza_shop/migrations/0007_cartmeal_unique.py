@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 10:17
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    CartMeal = apps.get_model('pizza_shop', 'CartMeal')
+    duplicates = CartMeal.objects.values('cart', 'meal').annotate(lines=Count('id')).filter(lines__gt=1)
+    for row in duplicates:
+        lines = list(CartMeal.objects.filter(cart=row['cart'], meal=row['meal']).order_by('id'))
+        CartMeal.objects.filter(pk=lines[0].pk).update(amount=sum(line.amount for line in lines))
+        CartMeal.objects.filter(pk__in=[line.pk for line in lines[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pizza_shop', '0006_order_states'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='cartmeal',
+            unique_together=set([('cart', 'meal')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 10:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pizza_shop', '0008_cart_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mealimage',
+            name='digest',
+            field=models.CharField(blank=True, default='', editable=False, max_length=40, verbose_name='Хеш изображения'),
+        ),
+    ]
@@ -1,9 +1,13 @@
 from django.contrib.auth.models import User
 from django.core.validators import RegexValidator
 from django.db import models
-from django.utils.deconstruct import deconstructible
+from django.db.models import F, Sum
+from django.utils import timezone
 import string
 import random
+import threading
+
+from pizza_shop.images import file_digest, derivative_url
 
 
 def generate_token(size=40, chars=string.ascii_uppercase + string.digits):
@@ -76,18 +80,30 @@ class Meal(models.Model):
         ordering = ['-add_date']
         verbose_name = 'Блюдо'
         verbose_name_plural = 'Блюда'
+        index_together = [
+            ['subsec', 'add_date'],
+        ]
 
 
 class MealImage(models.Model):
     meal = models.ForeignKey(Meal, related_name='imgs', verbose_name='Блюдо', on_delete=models.CASCADE)
     img = models.ImageField(upload_to=subclass_directory_path, verbose_name='Изображение')
     descr = models.TextField(verbose_name='Описание', null=True, blank=True)
+    # sha1 of the image bytes, names the generated thumbnails (see pizza_shop.images)
+    digest = models.CharField(max_length=40, blank=True, default='', editable=False, verbose_name='Хеш изображения')
 
     def __str__(self):
         return str(self.meal) + " Фото #" + str(self.id)
 
+    def save(self, *args, **kwargs):
+        if self.img and not self.img._committed:
+            # New upload, hash it before the storage moves it
+            self.digest = file_digest(self.img)
+        super(MealImage, self).save(*args, **kwargs)
+
     def image_tag(self):
-        return '%s<br><img src="%s" width="100" height="100" />' % (str(self), self.img.url)
+        url = derivative_url(self, 'admin') or self.img.url
+        return '%s<br><img src="%s" width="100" height="100" />' % (str(self), url)
 
     image_tag.short_description = 'Превью изображения'
     image_tag.allow_tags = True
@@ -145,7 +161,6 @@ class Ingredient(models.Model):
         verbose_name_plural = 'Ингредиенты'
 
 
-@deconstructible
 class State(models.Model):
     text = models.CharField(max_length=60, verbose_name='Статус')
     details = models.CharField(max_length=600, verbose_name='Подробнее', help_text='Более детальное описание статуса')
@@ -158,6 +173,56 @@ class State(models.Model):
         verbose_name_plural = 'Статусы заказов'
 
 
+class OrderStates(object):
+    """
+    Registry of the order states. Their ids are loaded once per process and cached,
+    so state transitions need no query. Missing states are created on first use.
+    """
+    PENDING = 'pending'
+    UNPAID = 'unpaid'
+    PAID = 'paid'
+
+    DEFINITIONS = {
+        PENDING: ('Ожидается', 'Заказ не оформлен'),
+        UNPAID: ('Не оплачен', 'Оплатите заказ'),
+        PAID: ('Оплачено', 'Спасибо за покупку'),
+    }
+
+    def __init__(self):
+        self._ids = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        texts = dict((text, key) for key, (text, details) in self.DEFINITIONS.items())
+        ids = {}
+        for pk, text in State.objects.filter(text__in=texts).order_by('pk').values_list('pk', 'text'):
+            ids.setdefault(texts[text], pk)
+        for key, (text, details) in self.DEFINITIONS.items():
+            if key not in ids:
+                ids[key] = State.objects.create(text=text, details=details).pk
+        return ids
+
+    def id(self, key):
+        ids = self._ids
+        if ids is None:
+            with self._lock:
+                if self._ids is None:
+                    self._ids = self._load()
+                ids = self._ids
+        return ids[key]
+
+    def clear(self):
+        self._ids = None
+
+
+order_states = OrderStates()
+
+
+def default_state():
+    # Resolved when a cart is created, importing the models touches no database
+    return order_states.id(OrderStates.PENDING)
+
+
 class Cart(models.Model):
     owner = models.ForeignKey(User, verbose_name='Покупатель', related_name='carts', blank=True, null=True)
     creation_date = models.DateTimeField(auto_now=True)
@@ -165,16 +230,29 @@ class Cart(models.Model):
     token = models.CharField(max_length=40, verbose_name='Токен корзины для сессий', default=generate_token)
     archive = models.BooleanField(verbose_name='Заказ оформлен', default=False)
 
-    status = models.ForeignKey('State', verbose_name='Статус заказа', related_name='carts',
-                               default=State.objects.get_or_create(text='Ожидается',
-                                                                    details='Заказ не оформлен')[0]
-                               )
+    status = models.ForeignKey('State', verbose_name='Статус заказа', related_name='carts', default=default_state)
 
     contact = models.CharField(max_length=20, null=True, default='', verbose_name='Контактные данные')
 
+    # Kept up to date by update_totals() on every change of the lines
+    total_amount = models.PositiveIntegerField(default=0, verbose_name='Количество блюд')
+    total_price = models.PositiveIntegerField(default=0, verbose_name='Сумма заказа')
+    # Incremented on every change of the lines, clients use it to skip refetching an unchanged cart
+    version = models.PositiveIntegerField(default=0, verbose_name='Версия корзины')
+
     def __str__(self):
         return 'Заказ #' + str(self.id)
 
+    def update_totals(self):
+        totals = self.cartmeal_set.aggregate(
+            total_amount=Sum('amount'),
+            total_price=Sum(F('amount') * F('price'), output_field=models.PositiveIntegerField()),
+        )
+        self.total_amount = totals['total_amount'] or 0
+        self.total_price = totals['total_price'] or 0
+        Cart.objects.filter(pk=self.pk).update(total_amount=self.total_amount, total_price=self.total_price,
+                                               version=F('version') + 1, creation_date=timezone.now())
+
     def meals_list(self):
         return '\n'.join([str(x.meal) + "\t" + str(x.amount) + " шт." for x in self.cartmeal_set.all()])
 
@@ -185,18 +263,12 @@ class Cart(models.Model):
                           self.cartmeal_set.all()])
 
     def meal_count(self):
-        s = 0
-        for cart_meal in self.cartmeal_set.all():
-            s += cart_meal.amount
-        return s
+        return self.total_amount
 
     meal_count.__name__ = 'Количество блюд'
 
     def sum_price(self):
-        price = 0
-        for cart_meal in self.cartmeal_set.all():
-            price += cart_meal.sum()
-        return price
+        return self.total_price
 
     sum_price.__name__ = 'Сумма заказа'
 
@@ -211,15 +283,21 @@ class Cart(models.Model):
         verbose_name = 'Корзина'
         verbose_name_plural = 'Корзины'
         ordering = ['-creation_date']
+        index_together = [
+            ['token', 'archive'],
+            ['owner', 'archive', 'creation_date'],
+        ]
 
 
 class CartMeal(models.Model):
     amount = models.PositiveSmallIntegerField(default=1, verbose_name='Количество')
     cart = models.ForeignKey(Cart, verbose_name='Корзина')
     meal = models.ForeignKey(Meal, verbose_name='Блюдо')
+    # Price of the meal when it was put into the cart, later price changes do not touch orders
+    price = models.PositiveSmallIntegerField(default=0, verbose_name='Цена')
 
     def sum(self):
-        return self.amount * self.meal.price
+        return self.amount * self.price
 
     def __str__(self):
         return str(self.meal)
@@ -227,6 +305,7 @@ class CartMeal(models.Model):
     class Meta:
         verbose_name = 'Блюдо в корзине'
         verbose_name_plural = 'Блюда в корзине'
+        unique_together = ('cart', 'meal')
 
 
 class Contact(models.Model):
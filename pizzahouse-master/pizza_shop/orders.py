@@ -0,0 +1,48 @@
+from django.db.models import Prefetch, Q
+
+from pizza_shop.models import Cart, CartMeal
+from pizza_shop.pagination import encode_cursor, decode_cursor
+
+ORDERS_PER_PAGE = 20
+
+
+class OrderHistoryPage(object):
+    """
+    A page of archived carts, newest first. next_cursor addresses the following (older) page.
+    """
+
+    def __init__(self, orders, has_next):
+        self.orders = orders
+        last = orders[-1] if orders else None
+        self.next_cursor = encode_cursor(last.creation_date, last.pk) if has_next else ''
+
+    def has_next(self):
+        return bool(self.next_cursor)
+
+    def __iter__(self):
+        return iter(self.orders)
+
+    def __len__(self):
+        return len(self.orders)
+
+
+def order_history(user, cursor=None, per_page=ORDERS_PER_PAGE):
+    """
+    Loads a page of the user's orders with their status, lines and meal titles in three queries,
+    however many orders the user has.
+    """
+    orders = Cart.objects.filter(owner=user, archive=True).select_related('status').prefetch_related(
+        Prefetch('cartmeal_set', queryset=CartMeal.objects.select_related('meal'))
+    )
+    before = decode_cursor(cursor) if cursor else None
+    if before is not None:
+        creation_date, pk = before
+        try:
+            pk = int(pk)
+        except ValueError:
+            # A meal page cursor or an edited one, treated like any other malformed cursor
+            before = None
+    if before is not None:
+        orders = orders.filter(Q(creation_date__lt=creation_date) | Q(creation_date=creation_date, pk__lt=pk))
+    orders = list(orders.order_by('-creation_date', '-pk')[:per_page + 1])
+    return OrderHistoryPage(orders[:per_page], len(orders) > per_page)
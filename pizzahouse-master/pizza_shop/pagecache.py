@@ -0,0 +1,142 @@
+import hashlib
+import re
+import time
+from datetime import datetime
+from functools import wraps
+
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.safestring import mark_safe
+from django.views.decorators.http import condition
+
+from pizza_shop.cart import get_request_cart, amount_in_cart, cart_etag
+from pizza_shop.catalog import catalog_version
+from pizza_shop.fragments import fragment_cache
+from pizza_shop.models import Meal
+from pizza_shop.snapshot import catalog_snapshot
+
+# Index and meal pages show random meals, cached shells are rotated so the picks still change
+PAGE_CACHE_ROTATE = 300
+HOLE_MARKER = re.compile(r'<!--hole:([\w:-]+)-->')
+
+
+def cart_panel(request):
+    return render_to_string('tags/thumb_cart.html', {'cart': get_request_cart(request)})
+
+
+def meal_amount(request, link):
+    meal = Meal(link=link)
+    return render_to_string('tags/meal_amount.html', {
+        'meal': meal,
+        'in_cart': amount_in_cart(get_request_cart(request), meal),
+    })
+
+
+# name: renderer(request, *args), the per-user parts of catalog pages
+HOLES = {
+    'cart': cart_panel,
+    'meal_amount': meal_amount,
+    'csrf': get_token,
+}
+
+
+def hole(request, name, *args):
+    """
+    The per-user block of a catalog page: a marker while the shared shell is rendered,
+    the block itself otherwise.
+    """
+    if getattr(request, 'page_shell', False):
+        return mark_safe('<!--hole:%s-->' % ':'.join((name,) + args))
+    return HOLES[name](request, *args)
+
+
+def fill_holes(request, shell):
+    def fill(match):
+        name, *args = match.group(1).split(':')
+        return HOLES[name](request, *args)
+    return HOLE_MARKER.sub(fill, shell)
+
+
+def page_rotation():
+    return int(time.time() // PAGE_CACHE_ROTATE)
+
+
+def page_cache_key(request):
+    path = request.get_full_path().encode('utf-8')
+    return 'page:%s:%d:%s' % (catalog_version(), page_rotation(), hashlib.md5(path).hexdigest())
+
+
+def cache_page_shell(view):
+    """
+    Caches catalog pages for anonymous users without the cart panel and the CSRF token,
+    those are filled in for every request. The shell lives in the fragment cache and
+    expires with the catalog version.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or request.user.is_authenticated():
+            return view(request, *args, **kwargs)
+
+        key = page_cache_key(request)
+        cache = fragment_cache()
+        shell = cache.get(key)
+        if shell is not None:
+            response = HttpResponse(fill_holes(request, shell))
+            response['X-Page-Cache'] = 'hit'
+            return response
+
+        token_used = request.META.get('CSRF_COOKIE_USED')
+        request.page_shell = True
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            request.page_shell = False
+        if response.status_code != 200 or response.streaming:
+            return response
+        if request.META.get('CSRF_COOKIE_USED') and not token_used:
+            # The token was rendered outside {% csrf_hole %}, the shell would hand it to everyone
+            return response
+        shell = response.content.decode(response.charset)
+        cache.set(key, shell)
+        response.content = fill_holes(request, shell)
+        response['X-Page-Cache'] = 'miss'
+        return response
+    return wrapper
+
+
+def catalog_condition(meals):
+    """
+    ETag and Last-Modified for a catalog view, so revalidations get a 304 without rendering.
+    meals(snapshot, *args, **kwargs) returns the meals the view shows from the catalog snapshot,
+    their newest add_date dates the content. The catalog version, the shell rotation, the user and
+    the cart version are mixed in, a page differs per user only through those.
+    """
+    def decorator(view):
+        def validators(request, *args, **kwargs):
+            if not hasattr(request, '_page_validators'):
+                snapshot = catalog_snapshot()
+                changed_at = max([meal.add_date.timestamp() for meal in meals(snapshot, *args, **kwargs)] or [0])
+                rotation = page_rotation()
+                cart = get_request_cart(request)
+                modified = [changed_at, snapshot.version / 1000, rotation * PAGE_CACHE_ROTATE]
+                if cart.pk:
+                    modified.append(cart.creation_date.timestamp())
+                etag = 'page-%s-%d-%d-%s-%s' % (snapshot.version, changed_at, rotation, request.user.pk or 0,
+                                                cart_etag(cart))
+                request._page_validators = (etag, datetime.utcfromtimestamp(max(modified)))
+            return request._page_validators
+
+        conditional_view = condition(etag_func=lambda *args, **kwargs: validators(*args, **kwargs)[0],
+                                     last_modified_func=lambda *args, **kwargs: validators(*args, **kwargs)[1])(view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            # Shared caches may keep the page, but must ask again and keep users apart
+            patch_cache_control(response, no_cache=True)
+            patch_vary_headers(response, ('Cookie',))
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,85 @@
+import base64
+from datetime import datetime
+
+from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
+from django.db.models import Q, QuerySet
+from django.utils import timezone
+
+MEALS_PER_PAGE = 24
+MEAL_ORDERING = ('-add_date', 'link')
+
+
+def encode_cursor(date, key):
+    stamp = timezone.make_naive(date, timezone.utc).strftime('%Y%m%d%H%M%S%f')
+    return base64.urlsafe_b64encode(('%s~%s' % (stamp, key)).encode()).decode()
+
+
+def decode_cursor(cursor):
+    # Returns (date, key) or None for a malformed cursor, the key is always a string
+    try:
+        stamp, key = base64.urlsafe_b64decode(cursor.encode()).decode().split('~', 1)
+        date = timezone.make_aware(datetime.strptime(stamp, '%Y%m%d%H%M%S%f'), timezone.utc)
+    except (TypeError, ValueError):
+        return None
+    return date, key
+
+
+class KeysetPage(object):
+    """
+    A page of meals addressed by the last meal of the previous page instead of an offset,
+    so deep pages cost the same as the first one.
+    """
+
+    def __init__(self, object_list, has_next):
+        self.object_list = object_list
+        self.next_cursor = encode_cursor(object_list[-1].add_date, object_list[-1].link) if has_next else ''
+
+    def has_next(self):
+        return bool(self.next_cursor)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def keyset_page(queryset, cursor, per_page=MEALS_PER_PAGE):
+    after = decode_cursor(cursor)
+    if isinstance(queryset, QuerySet):
+        if after is not None:
+            add_date, link = after
+            queryset = queryset.filter(Q(add_date__lt=add_date) | Q(add_date=add_date, link__gt=link))
+        meals = list(queryset.order_by(*MEAL_ORDERING)[:per_page + 1])
+    else:
+        # A list already in MEAL_ORDERING, e.g. from the catalog snapshot
+        meals = queryset
+        if after is not None:
+            add_date, link = after
+            start = next((i for i, meal in enumerate(meals) if meal.add_date < add_date or
+                          (meal.add_date == add_date and meal.link > link)), len(meals))
+            meals = meals[start:]
+        meals = list(meals[:per_page + 1])
+    return KeysetPage(meals[:per_page], len(meals) > per_page)
+
+
+def paginate_meals(request, queryset, per_page=MEALS_PER_PAGE):
+    # ?after=<cursor> switches to keyset pagination, otherwise pages are numbered.
+    # Takes a queryset or a list already sorted by MEAL_ORDERING
+    cursor = request.GET.get('after')
+    if cursor:
+        return keyset_page(queryset, cursor, per_page)
+
+    if isinstance(queryset, QuerySet):
+        queryset = queryset.order_by(*MEAL_ORDERING)
+    paginator = Paginator(queryset, per_page)
+    page = request.GET.get('page')
+    try:
+        meals = paginator.page(page)
+    except PageNotAnInteger:
+        # If page is not an integer, deliver first page.
+        meals = paginator.page(1)
+    except EmptyPage:
+        # If page is out of range (e.g. 9999), deliver last page of results.
+        meals = paginator.page(paginator.num_pages)
+    return meals
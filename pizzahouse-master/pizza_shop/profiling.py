@@ -0,0 +1,163 @@
+import fcntl
+import os
+import random
+import re
+import sys
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.core import signing
+
+from pizza_shop.metrics import view_name
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+TOKEN_SALT = 'pizza_shop.profiling'
+SAFE_NAME = re.compile(r'[^\w.:-]')
+
+
+def profile_dir():
+    return getattr(settings, 'PROFILE_DIR', os.path.join(settings.BASE_DIR, 'profiles'))
+
+
+def profile_token():
+    """Value of the X-Profile header that has a request profiled whatever the sample rate is"""
+    return signing.dumps('profile', salt=TOKEN_SALT)
+
+
+def has_valid_token(request):
+    token = request.META.get(PROFILE_HEADER)
+    if not token:
+        return False
+    try:
+        signing.loads(token, salt=TOKEN_SALT, max_age=getattr(settings, 'PROFILE_TOKEN_MAX_AGE', 24 * 3600))
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def frame_name(code):
+    # Flame graph tools split frames on ';' and a stack from its count on the last space
+    path = code.co_filename
+    if 'site-packages' in path:
+        path = path.split('site-packages', 1)[1].lstrip(os.sep)
+    elif path.startswith(settings.BASE_DIR):
+        path = os.path.relpath(path, settings.BASE_DIR)
+    else:
+        path = os.path.join(*path.split(os.sep)[-2:])
+    return ('%s:%s' % (path, code.co_name)).replace(';', ':').replace(' ', '_')
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler(object):
+    """
+    Takes the stack of one thread every `interval` seconds from a helper thread.
+    The profiled thread runs untouched, the cost is one stack walk per sample.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler')
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None and not self._in_sampler(frame):
+                self.stacks[collapse(frame)] += 1
+
+    def _in_sampler(self, frame):
+        # The moments the thread spends starting or stopping the sampler are not its own work
+        while frame is not None:
+            if frame.f_code in (StackSampler.start.__code__, StackSampler.stop.__code__):
+                return True
+            frame = frame.f_back
+        return False
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+
+def read_collapsed(path):
+    stacks = Counter()
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                if stack and count.isdigit():
+                    stacks[stack] += int(count)
+    except (IOError, OSError):
+        pass
+    return stacks
+
+
+def write_profile(view, stacks):
+    """Adds the samples of a request to <PROFILE_DIR>/<view>.collapsed, one 'stack count' line per stack"""
+    directory = profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, SAFE_NAME.sub('_', view) + '.collapsed')
+    # Workers of several processes add to the same files
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        merged = read_collapsed(path)
+        merged.update(stacks)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for stack, count in sorted(merged.items()):
+                f.write('%s %d\n' % (stack, count))
+        os.replace(tmp_path, path)
+    return path
+
+
+class ProfilingMiddleware(object):
+    """
+    Samples the stacks of a fraction of requests (PROFILE_SAMPLE_RATE) and of requests with
+    a signed X-Profile header, the samples are added to a collapsed stack file per view.
+    """
+
+    def process_request(self, request):
+        rate = getattr(settings, 'PROFILE_SAMPLE_RATE', 0)
+        if (rate and random.random() < rate) or has_valid_token(request):
+            request._profiler = StackSampler(threading.get_ident(),
+                                             getattr(settings, 'PROFILE_INTERVAL', 0.005)).start()
+
+    def process_response(self, request, response):
+        sampler = getattr(request, '_profiler', None)
+        if sampler is None:
+            return response
+        del request._profiler
+        stacks = sampler.stop()
+        if stacks:
+            write_profile(view_name(request), stacks)
+        return response
+
+
+# Frames that tell where the time of a stack goes, the first match from the leaf wins
+CATEGORIES = (
+    ('orm', ('django/db/',)),
+    ('template', ('django/template/', 'templatetags/')),
+)
+
+
+def stack_category(stack):
+    for name in reversed(stack.split(';')):
+        for category, parts in CATEGORIES:
+            if any(part in name for part in parts):
+                return category
+    return 'python'
@@ -0,0 +1,186 @@
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.utils import CursorWrapper
+from django.template.base import Node
+
+from pizza_shop.metrics import view_name, exporters, label_value
+
+logger = logging.getLogger('pizza_shop.querylog')
+
+_state = threading.local()
+
+
+def app_frames(frame):
+    """(path, line, function) of the project's own frames, outermost first"""
+    base = settings.BASE_DIR + os.sep
+    frames = []
+    for entry in traceback.extract_stack(frame):
+        path = entry[0]
+        if path.startswith(base) and 'site-packages' not in path and path != __file__:
+            frames.append((os.path.relpath(path, base), entry[1], entry[2]))
+    return frames
+
+
+def query_origin(frame):
+    """
+    Template name and line of the innermost node being rendered, None outside templates.
+    Queries of lazy relations in templates have no project frame to point at otherwise.
+    """
+    code = Node.render_annotated.__code__
+    while frame is not None:
+        if frame.f_code is code:
+            node = frame.f_locals.get('self')
+            origin, token = getattr(node, 'origin', None), getattr(node, 'token', None)
+            if origin is not None:
+                return '%s:%s' % (origin.template_name or origin.name, getattr(token, 'lineno', '?'))
+        frame = frame.f_back
+    return None
+
+
+class QueryEvent(object):
+    __slots__ = ('kind', 'sql', 'ms', 'count', 'template', 'stack')
+
+    def __init__(self, kind, sql, ms, count, frame):
+        self.kind = kind
+        self.sql = sql
+        self.ms = ms
+        self.count = count
+        self.template = query_origin(frame)
+        self.stack = app_frames(frame)
+
+    @property
+    def location(self):
+        if self.template:
+            return self.template
+        if self.stack:
+            return '%s:%s' % self.stack[-1][:2]
+        return 'unknown'
+
+    def log(self, view):
+        if self.kind == 'slow':
+            what = 'Slow query %.1fms' % self.ms
+        else:
+            what = 'Query repeated %d times' % self.count
+        logger.warning('%s in %s at %s: %s\n%s', what, view, self.location, self.sql,
+                       ''.join('  %s:%s in %s\n' % entry for entry in self.stack))
+
+
+class QueryStats(object):
+    """Per view counts of slow and repeated queries, and of the places they come from"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.events = defaultdict(int)
+        self.offenders = Counter()
+
+    def observe(self, view, events):
+        with self._lock:
+            for event in events:
+                self.events[view, event.kind] += 1
+                self.offenders[view, event.kind, event.location] += 1
+
+    def render(self):
+        with self._lock:
+            lines = ['# TYPE pizza_problem_queries_total counter']
+            for (view, kind), count in sorted(self.events.items()):
+                lines.append('pizza_problem_queries_total{view="%s",kind="%s"} %d' % (label_value(view), kind, count))
+            lines.append('# TYPE pizza_problem_query_origins_total counter')
+            for (view, kind, location), count in sorted(self.offenders.items()):
+                lines.append('pizza_problem_query_origins_total{view="%s",kind="%s",location="%s"} %d'
+                             % (label_value(view), kind, label_value(location), count))
+        return lines
+
+
+query_stats = QueryStats()
+exporters.append(query_stats.render)
+
+
+def record(sql, seconds):
+    ms = seconds * 1000
+    slow_ms = getattr(settings, 'QUERYLOG_SLOW_MS', None)
+    events = getattr(_state, 'events', None)
+    if events is None:
+        # Outside a request only slow queries are told about, right away
+        if slow_ms is not None and ms >= slow_ms:
+            QueryEvent('slow', sql, ms, 1, sys._getframe(2)).log('-')
+        return
+
+    if slow_ms is not None and ms >= slow_ms:
+        events.append(QueryEvent('slow', sql, ms, 1, sys._getframe(2)))
+    duplicates = getattr(settings, 'QUERYLOG_DUPLICATES', None)
+    if duplicates:
+        _state.counts[sql] += 1
+        # Once per statement and request, at the call that reaches the limit
+        if _state.counts[sql] == duplicates:
+            events.append(QueryEvent('duplicate', sql, ms, duplicates, sys._getframe(2)))
+
+
+class QueryLogCursor(CursorWrapper):
+    """Times every statement, the statement text without parameters identifies repeats"""
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            record(sql, time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            record(sql, time.time() - start)
+
+
+def instrument_cursors():
+    # Django 1.9 has no execute wrappers, wrap the cursors the connections hand out instead
+    if getattr(BaseDatabaseWrapper.make_cursor, 'logged', False):
+        return
+    make_cursor, make_debug_cursor = BaseDatabaseWrapper.make_cursor, BaseDatabaseWrapper.make_debug_cursor
+
+    def logged_cursor(self, cursor):
+        return QueryLogCursor(make_cursor(self, cursor), self)
+
+    def logged_debug_cursor(self, cursor):
+        return QueryLogCursor(make_debug_cursor(self, cursor), self)
+    logged_cursor.logged = logged_debug_cursor.logged = True
+    BaseDatabaseWrapper.make_cursor = logged_cursor
+    BaseDatabaseWrapper.make_debug_cursor = logged_debug_cursor
+
+
+class QueryLogMiddleware(object):
+    """
+    Logs queries slower than QUERYLOG_SLOW_MS and statements run QUERYLOG_DUPLICATES times in one
+    request, with the view, the template line and the project stack they come from.
+    """
+
+    def __init__(self):
+        instrument_cursors()
+
+    def process_request(self, request):
+        _state.events = []
+        _state.counts = Counter()
+
+    def process_response(self, request, response):
+        events = getattr(_state, 'events', None)
+        if events is None:
+            return response
+        _state.events = _state.counts = None
+        # The view is only known once the URL is resolved, so events are told about at the end
+        view = view_name(request)
+        for event in events:
+            event.log(view)
+        query_stats.observe(view, events)
+        return response
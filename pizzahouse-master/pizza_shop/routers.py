@@ -0,0 +1,57 @@
+import threading
+
+from django.core.signals import request_started, request_finished
+from django.db import connections, DEFAULT_DB_ALIAS
+
+REPLICA = 'replica'
+CATALOG_MODELS = frozenset(('section', 'subsection', 'meal', 'mealimage', 'infotype', 'mealinfo', 'ingredienttype',
+                            'ingredient', 'ingredient_inside'))
+
+_state = threading.local()
+
+
+def replica_enabled():
+    # The test runner points a mirror at the primary's database, that is no replica
+    if REPLICA not in connections.databases:
+        return False
+    return connections[REPLICA].settings_dict['NAME'] != connections[DEFAULT_DB_ALIAS].settings_dict['NAME']
+
+
+def reset_sticky(**kwargs):
+    _state.wrote = False
+
+
+request_started.connect(reset_sticky, dispatch_uid='pizza_shop.routers.reset_sticky')
+request_finished.connect(reset_sticky, dispatch_uid='pizza_shop.routers.reset_sticky_finished')
+
+
+class CatalogReplicaRouter(object):
+    """
+    Catalog reads go to the read-only replica, everything else and all writes to the primary.
+    After its first write a request (or a thread outside of requests) reads only the primary,
+    so it sees what it has just written. Caches kept until the next catalog change, like the
+    catalog snapshot, read the primary explicitly.
+    """
+
+    def db_for_read(self, model, **hints):
+        # An explicit answer either way, otherwise Django reads related objects from the instance's database
+        if (model._meta.app_label == 'pizza_shop' and model._meta.model_name in CATALOG_MODELS
+                and not getattr(_state, 'wrote', False) and replica_enabled()):
+            return REPLICA
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows, a meal read from it may be put into a cart
+        if {obj1._state.db, obj2._state.db} <= {DEFAULT_DB_ALIAS, REPLICA}:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica is a copy of the migrated primary
+        if db == REPLICA:
+            return False
+        return None
@@ -0,0 +1,58 @@
+import random
+import threading
+import time
+
+from django.db import DEFAULT_DB_ALIAS
+
+from pizza_shop.models import Meal
+
+
+class MealSampler(object):
+    """
+    Keeps the primary keys of all meals in memory and draws random meals from them,
+    so picking k meals no longer sorts the whole table with ORDER BY RANDOM().
+    """
+
+    def __init__(self, ttl=300):
+        # Signals only reach this process, the ttl bounds staleness for changes made by other workers
+        self.ttl = ttl
+        self._keys = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._keys = None
+
+    def _stale(self, keys):
+        return keys is None or time.time() - self._loaded_at > self.ttl
+
+    def _load(self):
+        return list(Meal.objects.using(DEFAULT_DB_ALIAS).order_by().values_list('link', flat=True))
+
+    def keys(self):
+        keys = self._keys
+        if self._stale(keys):
+            with self._lock:
+                # The threads that waited here find the keys the first one loaded
+                keys = self._keys
+                if self._stale(keys):
+                    keys = self._load()
+                    self._keys, self._loaded_at = keys, time.time()
+        return keys
+
+    def sample_keys(self, k, exclude=()):
+        keys = self.keys()
+        # random.sample() picks from a list in O(k) once the list is much larger than k
+        picked = random.sample(keys, min(len(keys), k + len(exclude)))
+        return [key for key in picked if key not in exclude][:k]
+
+    def sample(self, k, exclude=(), queryset=None):
+        keys = self.sample_keys(k, exclude)
+        if queryset is None:
+            queryset = Meal.objects.all()
+        meals = dict((meal.pk, meal) for meal in queryset.filter(link__in=keys))
+        # Keep the random order, skip meals deleted by another worker since the keys were loaded
+        return [meals[key] for key in keys if key in meals]
+
+
+meal_sampler = MealSampler()
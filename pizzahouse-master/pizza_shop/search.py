@@ -0,0 +1,152 @@
+import bisect
+import re
+import threading
+import time
+from collections import defaultdict
+
+from django.db import DEFAULT_DB_ALIAS
+
+from pizza_shop.models import Meal, Ingredient
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Inflectional endings stripped by the light russian stemmer, longest first
+ENDINGS = sorted((
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ый', 'ий', 'ой',
+    'ую', 'юю', 'ах', 'ях', 'ам', 'ям', 'ов', 'ев', 'ей', 'ом', 'ем', 'ою', 'ею', 'а', 'я', 'о', 'е', 'ы', 'и',
+    'у', 'ю', 'ь', 'й',
+), key=len, reverse=True)
+MIN_STEM = 3
+
+FIELD_WEIGHTS = {
+    'title': 4,
+    'keywords': 2,
+    'ingredients': 2,
+    'descr': 1,
+}
+PREFIX_WEIGHT = 0.5
+
+
+def stem(word):
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text):
+    return [stem(word) for word in WORD_RE.findall((text or '').lower().replace('ё', 'е'))]
+
+
+class SearchIndex(object):
+    """
+    In-process inverted index over meal titles, descriptions, keywords and ingredient names.
+    It is built lazily from two queries and then kept up to date by model signals.
+    """
+
+    def __init__(self, ttl=600):
+        # Signals only reach this process, the ttl bounds staleness for changes made by other workers
+        self.ttl = ttl
+        self._postings = None
+        self._docs = {}
+        self._terms = []
+        self._built_at = 0
+        self._lock = threading.RLock()
+
+    def _document(self, title, descr, keywords, ingredients):
+        weights = defaultdict(float)
+        fields = (('title', title), ('descr', descr), ('keywords', keywords), ('ingredients', ' '.join(ingredients)))
+        for field, text in fields:
+            for term in tokenize(text):
+                weights[term] += FIELD_WEIGHTS[field]
+        return weights
+
+    def _add(self, link, weights):
+        self._remove(link)
+        for term, weight in weights.items():
+            self._postings.setdefault(term, {})[link] = weight
+        self._docs[link] = set(weights)
+        self._terms = None
+
+    def _remove(self, link):
+        for term in self._docs.pop(link, ()):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(link, None)
+                if not postings:
+                    del self._postings[term]
+        self._terms = None
+
+    def build(self):
+        ingredients = defaultdict(list)
+        # From the primary like the catalog snapshot, the updates come right after the commit
+        for meal_link, title in Ingredient.inside.through.objects.using(DEFAULT_DB_ALIAS).values_list(
+                'meal_id', 'ingredient__title'):
+            ingredients[meal_link].append(title)
+        with self._lock:
+            self._postings, self._docs = {}, {}
+            for link, title, descr, keywords in Meal.objects.using(DEFAULT_DB_ALIAS).order_by().values_list(
+                    'link', 'title', 'descr', 'keywords'):
+                self._add(link, self._document(title, descr, keywords, ingredients[link]))
+            self._built_at = time.time()
+
+    def _ensure_built(self):
+        if self._postings is None or time.time() - self._built_at > self.ttl:
+            self.build()
+
+    def update_meals(self, links):
+        with self._lock:
+            if self._postings is None:
+                return
+            links = set(links)
+            ingredients = defaultdict(list)
+            through = Ingredient.inside.through.objects.using(DEFAULT_DB_ALIAS)
+            for meal_link, title in through.filter(meal__in=links).values_list('meal_id', 'ingredient__title'):
+                ingredients[meal_link].append(title)
+            found = set()
+            meals = Meal.objects.using(DEFAULT_DB_ALIAS).filter(link__in=links)
+            for link, title, descr, keywords in meals.values_list('link', 'title', 'descr', 'keywords'):
+                self._add(link, self._document(title, descr, keywords, ingredients[link]))
+                found.add(link)
+            for link in links - found:
+                self._remove(link)
+
+    def remove_meal(self, link):
+        with self._lock:
+            if self._postings is not None:
+                self._remove(link)
+
+    def _prefixed(self, prefix):
+        if self._terms is None:
+            self._terms = sorted(self._postings)
+        i = bisect.bisect_left(self._terms, prefix)
+        while i < len(self._terms) and self._terms[i].startswith(prefix):
+            yield self._terms[i]
+            i += 1
+
+    def search(self, query, limit=60):
+        """
+        Returns meal links ranked by the number of matched query words, then by field weights.
+        Words also match as prefixes of indexed words, so results show up while the user types.
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        with self._lock:
+            self._ensure_built()
+            matched = defaultdict(int)
+            scores = defaultdict(float)
+            for term in terms:
+                hits = {}
+                for indexed in self._prefixed(term):
+                    factor = 1 if indexed == term else PREFIX_WEIGHT
+                    for link, weight in self._postings[indexed].items():
+                        hits[link] = max(hits.get(link, 0), weight * factor)
+                for link, weight in hits.items():
+                    matched[link] += 1
+                    scores[link] += weight
+        ranked = sorted(scores, key=lambda link: (-matched[link], -scores[link], link))
+        return ranked[:limit]
+
+
+search_index = SearchIndex()
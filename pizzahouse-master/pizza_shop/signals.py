@@ -0,0 +1,107 @@
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+
+from pizza_shop.catalog import bump_catalog_version
+from pizza_shop.images import schedule_derivatives
+from pizza_shop.models import Section, SubSection, Meal, MealImage, MealInfo, Ingredient, State, order_states
+from pizza_shop.sampling import meal_sampler
+from pizza_shop.search import search_index
+
+logger = logging.getLogger('pizza_shop.signals')
+
+
+@receiver([post_save, post_delete], sender=Meal)
+def meal_changed(sender, instance, **kwargs):
+    transaction.on_commit(meal_sampler.invalidate)
+
+
+@receiver([post_save, post_delete], sender=State)
+def state_changed(sender, instance, **kwargs):
+    transaction.on_commit(order_states.clear)
+
+
+@receiver([post_save, post_delete], sender=Section)
+@receiver([post_save, post_delete], sender=SubSection)
+@receiver([post_save, post_delete], sender=Meal)
+@receiver([post_save, post_delete], sender=MealImage)
+@receiver([post_save, post_delete], sender=Ingredient)
+@receiver([post_save, post_delete], sender=MealInfo)
+def catalog_changed(sender, **kwargs):
+    # Caches are rebuilt by whoever sees the new version first, that must be after the change is visible
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(m2m_changed, sender=Ingredient.inside.through)
+def catalog_ingredients_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(bump_catalog_version)
+
+
+@receiver(post_save, sender=MealImage)
+def build_meal_image_derivatives(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    future = schedule_derivatives(instance)
+    if hasattr(future, 'add_done_callback'):
+        image_id, digest = instance.pk, instance.digest
+
+        def derivatives_done(f):
+            if f.exception() is not None:
+                logger.error('Derivatives of MealImage %s (%s) failed', image_id, digest, exc_info=f.exception())
+                return
+            # Cached cards still point at the original image, drop them once the thumbnails exist
+            bump_catalog_version()
+
+        future.add_done_callback(derivatives_done)
+
+
+@receiver(post_save, sender=Meal)
+def index_meal(sender, instance, **kwargs):
+    link = instance.pk
+    transaction.on_commit(lambda: search_index.update_meals([link]))
+
+
+@receiver(post_delete, sender=Meal)
+def unindex_meal(sender, instance, **kwargs):
+    link = instance.pk
+    transaction.on_commit(lambda: search_index.remove_meal(link))
+
+
+@receiver(post_save, sender=Ingredient)
+def index_ingredient(sender, instance, **kwargs):
+    transaction.on_commit(lambda: search_index.update_meals(instance.inside.values_list('link', flat=True)))
+
+
+@receiver(pre_delete, sender=Ingredient)
+def unindex_ingredient(sender, instance, **kwargs):
+    # The m2m rows are gone after the delete, remember the meals to reindex them
+    instance._indexed_meals = list(instance.inside.values_list('link', flat=True))
+
+
+@receiver(post_delete, sender=Ingredient)
+def reindex_ingredient_meals(sender, instance, **kwargs):
+    links = getattr(instance, '_indexed_meals', ())
+    transaction.on_commit(lambda: search_index.update_meals(links))
+
+
+@receiver(m2m_changed, sender=Ingredient.inside.through)
+def index_ingredient_meals(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear', 'post_clear'):
+        return
+    if action == 'pre_clear':
+        # pk_set is not given on clear, collect the affected meals before the rows disappear
+        if reverse:
+            instance._cleared_meals = [instance.pk]
+        else:
+            instance._cleared_meals = list(instance.inside.values_list('link', flat=True))
+        return
+    if action == 'post_clear':
+        links = getattr(instance, '_cleared_meals', ())
+    elif reverse:
+        links = [instance.pk]
+    else:
+        links = list(pk_set)
+    transaction.on_commit(lambda: search_index.update_meals(links))
@@ -0,0 +1,196 @@
+import threading
+from collections import defaultdict
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.fields.files import FieldFile
+
+from pizza_shop.catalog import catalog_version
+from pizza_shop.models import Section, SubSection, Meal, MealImage, MealInfo, Ingredient
+from pizza_shop.pagination import MEAL_ORDERING
+
+
+class RecordList(tuple):
+    """A tuple that templates can treat like a related manager: .all, .first, .count"""
+
+    def all(self):
+        return self
+
+    def first(self):
+        return self[0] if self else None
+
+    def count(self):
+        return len(self)
+
+
+class Record(object):
+    """Read-only record, attributes are set once while the snapshot is built"""
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def _set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def __str__(self):
+        return self.title
+
+
+class SectionRecord(Record):
+    __slots__ = ('link', 'title', 'img', 'descr', 'keywords', 'subsecs')
+
+    @property
+    def pk(self):
+        return self.link
+
+
+class SubSectionRecord(Record):
+    __slots__ = ('link', 'title', 'img', 'descr', 'keywords', 'sec', 'meals')
+
+    @property
+    def pk(self):
+        return self.link
+
+    @property
+    def sec_id(self):
+        return self.sec.link
+
+
+class MealRecord(Record):
+    __slots__ = ('link', 'title', 'price', 'weight', 'descr', 'keywords', 'add_date', 'subsec',
+                 'imgs', 'ingredients', 'info')
+
+    @property
+    def pk(self):
+        return self.link
+
+    @property
+    def subsec_id(self):
+        return self.subsec.link
+
+    @property
+    def main_img(self):
+        return self.imgs.first()
+
+
+class ImageRecord(Record):
+    __slots__ = ('id', 'img', 'descr', 'digest')
+
+    def __str__(self):
+        return self.img.name
+
+    def url(self):
+        return self.img.url
+
+
+class IngredientRecord(Record):
+    __slots__ = ('id', 'title', 'descr')
+
+
+class InfoRecord(Record):
+    __slots__ = ('type', 'value')
+
+    def __str__(self):
+        return self.value
+
+
+def _file(model, name):
+    # A file without the model instance behind it, url and storage are all templates need
+    return FieldFile(None, model._meta.get_field('img'), name)
+
+
+class CatalogSnapshot(object):
+    """
+    The whole catalog tree loaded in a fixed number of queries, with indexes by link.
+    Never changed after it is built, a new snapshot replaces it when the catalog version moves.
+    It is read from the primary: built from a replica that has not caught up yet it would keep
+    the old catalog under the new version.
+    """
+
+    def __init__(self, version, using=DEFAULT_DB_ALIAS):
+        self.version = version
+
+        self.sections = {}
+        for sec in Section.objects.using(using).order_by('link'):
+            self.sections[sec.link] = SectionRecord(link=sec.link, title=sec.title, img=_file(Section, sec.img.name),
+                                                    descr=sec.descr, keywords=sec.keywords)
+        self.subsections = {}
+        subsecs_of = defaultdict(list)
+        for subsec in SubSection.objects.using(using):
+            record = SubSectionRecord(link=subsec.link, title=subsec.title, img=_file(SubSection, subsec.img.name),
+                                      descr=subsec.descr, keywords=subsec.keywords, sec=self.sections[subsec.sec_id])
+            self.subsections[subsec.link] = record
+            subsecs_of[subsec.sec_id].append(record)
+
+        imgs_of = defaultdict(list)
+        for img in MealImage.objects.using(using).order_by('id'):
+            imgs_of[img.meal_id].append(ImageRecord(id=img.id, img=_file(MealImage, img.img.name),
+                                                    descr=img.descr, digest=img.digest))
+        ingredients = dict((ing.id, IngredientRecord(id=ing.id, title=ing.title, descr=ing.descr))
+                           for ing in Ingredient.objects.using(using))
+        ingredients_of = defaultdict(list)
+        for meal_id, ingredient_id in Ingredient.inside.through.objects.using(using).order_by('id').values_list(
+                'meal_id', 'ingredient_id'):
+            ingredients_of[meal_id].append(ingredients[ingredient_id])
+        info_of = defaultdict(list)
+        for info in MealInfo.objects.using(using).select_related('info_type').order_by('id'):
+            info_of[info.meal_id].append(InfoRecord(type=info.info_type.type, value=info.value))
+
+        self.meals = {}
+        meals_of = defaultdict(list)
+        for meal in Meal.objects.using(using).order_by(*MEAL_ORDERING):
+            record = MealRecord(link=meal.link, title=meal.title, price=meal.price, weight=meal.weight,
+                                descr=meal.descr, keywords=meal.keywords, add_date=meal.add_date,
+                                subsec=self.subsections[meal.subsec_id],
+                                imgs=RecordList(imgs_of[meal.link]),
+                                ingredients=RecordList(ingredients_of[meal.link]),
+                                info=RecordList(info_of[meal.link]))
+            self.meals[meal.link] = record
+            meals_of[meal.subsec_id].append(record)
+
+        for link, record in self.subsections.items():
+            record._set('meals', RecordList(meals_of[link]))
+        self._section_meals = {}
+        for link, record in self.sections.items():
+            record._set('subsecs', RecordList(subsecs_of[link]))
+            # Keep the catalog order across subsections, like the section page query did
+            meals = [meal for subsec in record.subsecs for meal in subsec.meals]
+            meals.sort(key=lambda meal: meal.link)
+            meals.sort(key=lambda meal: meal.add_date, reverse=True)
+            self._section_meals[link] = RecordList(meals)
+        self.section_list = RecordList(self.sections[link] for link in sorted(self.sections))
+
+    def section_meals(self, link):
+        return self._section_meals.get(link, RecordList())
+
+    def subsection_meals(self, link):
+        subsec = self.subsections.get(link)
+        return subsec.meals if subsec is not None else RecordList()
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def catalog_snapshot():
+    """
+    The snapshot of the current catalog version, rebuilt by the first caller after a change.
+    Callers that come while it is rebuilt get the previous snapshot, only the first build is waited for.
+    """
+    global _snapshot
+    version = catalog_version()
+    snapshot = _snapshot
+    if snapshot is None or snapshot.version != version:
+        if not _snapshot_lock.acquire(snapshot is None):
+            return snapshot
+        try:
+            snapshot = _snapshot
+            if snapshot is None or snapshot.version != version:
+                snapshot = _snapshot = CatalogSnapshot(version)
+        finally:
+            _snapshot_lock.release()
+    return snapshot
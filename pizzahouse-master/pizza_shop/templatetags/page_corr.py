@@ -1,5 +1,10 @@
 from django import template
 
+from pizza_shop.catalog import catalog_version
+from pizza_shop.fragments import fragment_cache
+from pizza_shop.images import picture_sources
+from pizza_shop.pagecache import hole
+
 register = template.Library()
 
 LEADING_PAGE_RANGE_DISPLAYED = TRAILING_PAGE_RANGE_DISPLAYED = 2
@@ -8,21 +13,75 @@ NUM_PAGES_OUTSIDE_RANGE = 2
 ADJACENT_PAGES = 3
 
 
-@register.inclusion_tag('tags/thumb_cart.html')
-def thumb_cart(cart):
-    return {
-        'cart': cart
-    }
+class FragmentNode(template.Node):
+
+    def __init__(self, name, vary_on, nodelist):
+        self.name = name
+        self.vary_on = vary_on
+        self.nodelist = nodelist
+
+    def render(self, context):
+        parts = [self.name, str(catalog_version())] + [str(var.resolve(context)) for var in self.vary_on]
+        key = 'fragment:' + ':'.join(parts)
+        cache = fragment_cache()
+        value = cache.get(key)
+        if value is None:
+            value = self.nodelist.render(context)
+            cache.set(key, value)
+        return value
+
+
+@register.tag
+def fragment(parser, token):
+    """
+    {% fragment 'name' var1 var2 %}...{% endfragment %}
+    Caches the rendered block per name, values of the vars and the catalog version.
+    """
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError("'%s' tag requires at least a fragment name" % bits[0])
+    nodelist = parser.parse(('endfragment',))
+    parser.delete_first_token()
+    name = bits[1].strip('\'"')
+    return FragmentNode(name, [parser.compile_filter(bit) for bit in bits[2:]], nodelist)
+
+
+@register.simple_tag(takes_context=True)
+def thumb_cart(context, cart):
+    # Left as a hole in cached page shells, see pizza_shop.pagecache
+    return hole(context.request, 'cart')
+
+
+@register.simple_tag(takes_context=True)
+def meal_amount(context, meal):
+    return hole(context.request, 'meal_amount', meal.link)
+
+
+@register.simple_tag(takes_context=True)
+def csrf_hole(context):
+    # The CSRF token value, {{ csrf_token }} would end up in the shared page shell
+    return hole(context.request, 'csrf')
 
 
 @register.inclusion_tag('tags/meal_info.html')
 def meal_info(meal, subsec=False):
+    # Catalog snapshot records carry main_img, fall back to a query for model instances
+    img = meal.main_img if hasattr(meal, 'main_img') else meal.imgs.first()
     return {
         'meal': meal,
+        'img': img,
         'subsection': subsec
     }
 
 
+@register.inclusion_tag('tags/picture.html')
+def picture(img, alt='', size='card', retina_size='card2x', **attrs):
+    # WebP and JPEG thumbnails of a MealImage, the original until the workers have built them
+    context = picture_sources(img, size, retina_size)
+    context.update(alt=alt, attrs=attrs)
+    return context
+
+
 @register.inclusion_tag('tags/pagination.html')
 def pagination(page_obj):
     paginator = page_obj.paginator
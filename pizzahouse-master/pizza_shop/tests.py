@@ -1,3 +1,960 @@
-from django.test import TestCase
+import base64
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.contrib.auth.models import User, AnonymousUser
+from django.core.cache import caches
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, close_old_connections, transaction, OperationalError
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.template import Template, Context
+from django.template.base import Origin
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+
+from pizza_shop.assets import serve_asset
+from pizza_shop.benchmark import generate_dataset, run_benchmark, compare_reports, clear_dataset
+from pizza_shop.cartstore import flush_live_carts, cart_lock, check_cart_cache, CartLocked, LOCK_KEY, STATE_KEY
+from pizza_shop.catalog import catalog_version, bump_catalog_version
+from pizza_shop.database import serialized_write, is_locked
+from pizza_shop.fragments import fragment_cache, LocMemLRUCache, FileLRUCache
+from pizza_shop.images import SIZES, derivative_name, derivative_url, ready_marker_name
+from pizza_shop.metrics import request_metrics, label_value
+from pizza_shop.models import Section, SubSection, Meal, MealImage, Ingredient, IngredientType, Cart, CartMeal, \
+    State, OrderStates, order_states
+from pizza_shop.orders import order_history
+from pizza_shop.pagecache import cache_page_shell, page_cache_key
+from pizza_shop.pagination import encode_cursor, keyset_page, MEAL_ORDERING, MEALS_PER_PAGE
+from pizza_shop.profiling import StackSampler, profile_token, read_collapsed
+from pizza_shop.querylog import query_stats, QueryLogMiddleware
+from pizza_shop.routers import reset_sticky
+from pizza_shop.sampling import MealSampler
+from pizza_shop.search import search_index
+from pizza_shop.snapshot import catalog_snapshot, _snapshot_lock
+
+
+def create_catalog(**meal_fields):
+    """The pizza section with the hot subsection and the margherita in it, the catalog most tests need"""
+    sec = Section.objects.create(link='pizza', title='Пицца', img='sec.jpg')
+    subsec = SubSection.objects.create(link='hot', title='Горячая', sec=sec, img='subsec.jpg')
+    fields = dict(title='Маргарита', price=300, weight='500')
+    fields.update(meal_fields)
+    meal = Meal.objects.create(link='margherita', subsec=subsec, **fields)
+    return sec, subsec, meal
+
+
+def run_commit_hooks():
+    # TestCase never commits, run the on_commit callbacks a commit of the changes so far would run
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for sids, func in callbacks:
+        func()
+
+
+def check_set(test):
+    def post(data):
+        return test.client.post('/handler/', dict(data, type='set'), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    test.assertEqual(post({'meal': 'nope', 'amount': 2}).content, b'ERROR')
+    test.assertEqual(post({'meal': 'nope', 'amount': 0}).content, b'ERROR')
+    test.assertContains(post({'meal': 'margherita', 'amount': 3}), '3&nbsp;шт.')
+    # Without an amount the line is kept as it is
+    test.assertEqual(post({'meal': 'margherita'}).content, b'ERROR')
+    test.assertEqual(post({'meal': 'margherita', 'amount': ''}).content, b'ERROR')
+    test.assertEqual(test.client.get('/cart/').json()['total_amount'], 3)
+    test.assertEqual(post({'meal': 'margherita', 'amount': 0}).content, b'')
+    test.assertEqual(test.client.get('/cart/').json()['total_amount'], 0)
+    post({'meal': 'margherita', 'amount': 3})
+
+
+class CatalogTestCase(TestCase):
+    # Fields of the margherita that differ from create_catalog's
+    meal_fields = {}
+
+    @classmethod
+    def setUpClass(cls):
+        # Order state ids cached by an earlier class may belong to rows that were rolled back or flushed
+        order_states.clear()
+        super(CatalogTestCase, cls).setUpClass()
+        # The catalog version, sampler and search index must not keep the previous class's catalog
+        run_commit_hooks()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sec, cls.subsec, cls.meal = create_catalog(**cls.meal_fields)
+
+
+class MealCardQueriesTest(CatalogTestCase):
+    """
+    Rendering a list of meal cards must cost the same number of queries whatever the page size.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        for link, count in (('few', 2), ('many', 20)):
+            sec = Section.objects.create(link=link, title=link, img='sec.jpg')
+            subsec = SubSection.objects.create(link=link + 'sub', title=link, sec=sec, img='subsec.jpg')
+            for i in range(count):
+                meal = Meal.objects.create(link='%s%d' % (link, i), title='%s %d' % (link, i), price=100,
+                                           weight='500', subsec=subsec)
+                MealImage.objects.create(meal=meal, img='%s.jpg' % meal.link)
+                MealImage.objects.create(meal=meal, img='%s_2.jpg' % meal.link)
+
+    def count_queries(self, url, data=None):
+        # Compare cold renders, cached fragments would hide the queries of the first page
+        fragment_cache().clear()
+        with CaptureQueriesContext(connection) as queries:
+            if data is None:
+                response = self.client.get(url)
+            else:
+                response = self.client.post(url, data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_section_page(self):
+        self.assertEqual(self.count_queries('/few/'), self.count_queries('/many/'))
+
+    def test_subsection_page(self):
+        self.assertEqual(self.count_queries('/few/fewsub/'), self.count_queries('/many/manysub/'))
+
+    def test_search(self):
+        search_index.build()
+        self.assertEqual(self.count_queries('/handler/', {'type': 'search', 'meal': 'few'}),
+                         self.count_queries('/handler/', {'type': 'search', 'meal': 'many'}))
+
+    def test_primary_image(self):
+        response = self.client.get('/few/fewsub/')
+        self.assertContains(response, 'few0.jpg')
+        self.assertNotContains(response, 'few0_2.jpg')
+
+
+class SearchIndexTest(CatalogTestCase):
+    meal_fields = {'title': 'Пицца Маргарита', 'descr': 'Классическая итальянская пицца'}
+
+    @classmethod
+    def setUpTestData(cls):
+        super(SearchIndexTest, cls).setUpTestData()
+        cls.pepperoni = Meal.objects.create(link='pepperoni', title='Пепперони', weight='500', subsec=cls.subsec,
+                                            keywords='острая пицца')
+        cls.type = IngredientType.objects.create(title='Сыры')
+
+    def setUp(self):
+        search_index.build()
+
+    def test_ranking(self):
+        self.assertEqual(search_index.search('пицца'), ['margherita', 'pepperoni'])
+        self.assertEqual(search_index.search('острой пиццы'), ['pepperoni', 'margherita'])
+
+    def test_prefix_and_yo(self):
+        self.assertEqual(search_index.search('марг'), ['margherita'])
+        self.assertEqual(search_index.search('ИТАЛЬЯНСКАЯ'), ['margherita'])
+
+    def test_incremental_updates(self):
+        cheese = Ingredient.objects.create(title='Моцарелла', type=self.type)
+        cheese.inside.add(self.pepperoni)
+        run_commit_hooks()
+        self.assertEqual(search_index.search('моцарелла'), ['pepperoni'])
+        cheese.inside.clear()
+        run_commit_hooks()
+        self.assertEqual(search_index.search('моцарелла'), [])
+        self.pepperoni.title = 'Пепперони с халапеньо'
+        self.pepperoni.save()
+        run_commit_hooks()
+        self.assertEqual(search_index.search('халапеньо'), ['pepperoni'])
+        self.pepperoni.delete()
+        run_commit_hooks()
+        self.assertEqual(search_index.search('пицца'), ['margherita'])
+
+
+class MealImageDerivativesTest(CatalogTestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+
+    def upload(self):
+        data = io.BytesIO()
+        Image.new('RGB', (1200, 900), 'red').save(data, 'JPEG')
+        image = MealImage(meal=self.meal, img=SimpleUploadedFile('photo.jpg', data.getvalue()))
+        image.save()
+        return image
+
+    def test_derivatives_built_on_upload(self):
+        with self.settings(MEDIA_ROOT=self.media_root, THUMBNAIL_WORKERS=0):
+            image = self.upload()
+            run_commit_hooks()
+            self.assertEqual(len(image.digest), 40)
+            for size, (width, height, crop) in SIZES.items():
+                with Image.open(os.path.join(self.media_root, derivative_name(image.digest, size, 'webp'))) as thumb:
+                    self.assertLessEqual(thumb.size, (width, height))
+            self.assertTrue(os.path.exists(os.path.join(self.media_root, ready_marker_name(image.digest))))
+            response = self.client.get('/pizza/hot/')
+        self.assertContains(response, derivative_name(image.digest, 'card', 'webp'))
+        self.assertContains(response, derivative_name(image.digest, 'card2x', 'jpeg') + ' 2x')
+
+    def test_same_bytes_share_derivatives(self):
+        with self.settings(MEDIA_ROOT=self.media_root, THUMBNAIL_WORKERS=0):
+            self.assertEqual(self.upload().digest, self.upload().digest)
+
+    def test_storage_checked_once_per_image(self):
+        with self.settings(MEDIA_ROOT=self.media_root, THUMBNAIL_WORKERS=0):
+            image = self.upload()
+            exists_on_disk = FileSystemStorage.exists
+            with mock.patch.object(FileSystemStorage, 'exists', autospec=True, side_effect=exists_on_disk) as exists:
+                for size in SIZES:
+                    self.assertTrue(derivative_url(image, size, 'webp'))
+                    self.assertTrue(derivative_url(image, size, 'jpeg'))
+            self.assertEqual(exists.call_count, 1)
+
+    def test_failed_derivatives_keep_version(self):
+        future = Future()
+        with self.settings(MEDIA_ROOT=self.media_root), \
+                mock.patch('pizza_shop.signals.schedule_derivatives', return_value=future):
+            self.upload()
+        run_commit_hooks()
+        version = catalog_version()
+        with self.assertLogs('pizza_shop.signals', 'ERROR'):
+            future.set_exception(OSError('cannot identify image file'))
+        self.assertEqual(catalog_version(), version)
+
+        future = Future()
+        with self.settings(MEDIA_ROOT=self.media_root), \
+                mock.patch('pizza_shop.signals.schedule_derivatives', return_value=future):
+            self.upload()
+        run_commit_hooks()
+        version = catalog_version()
+        future.set_result([])
+        self.assertNotEqual(catalog_version(), version)
+
+
+class StaticBuildTest(TestCase):
+
+    def setUp(self):
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root)
+        settings = self.settings(STATIC_ROOT=static_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        call_command('build_static', stdout=io.StringIO())
+
+    def test_hashed_urls(self):
+        hashed = staticfiles_storage.stored_name('css/bootstrap.min.css')
+        self.assertNotEqual(hashed, 'css/bootstrap.min.css')
+        self.assertContains(self.client.get('/about/'), '/static/' + hashed)
+        self.assertFalse(staticfiles_storage.exists('css/bootstrap.css'))
+
+    def test_precompressed_asset(self):
+        hashed = staticfiles_storage.stored_name('js/jquery.js')
+        request = RequestFactory().get('/static/' + hashed, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        response = serve_asset(request, hashed)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('javascript', response['Content-Type'])
+        self.assertIn('immutable', response['Cache-Control'])
+        response.close()
+        response = serve_asset(RequestFactory().get('/static/js/jquery.js'), 'js/jquery.js')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertNotIn('immutable', response['Cache-Control'])
+        response.close()
+
+
+class FragmentCacheTest(CatalogTestCase):
+
+    def test_catalog_pages_render_from_cache(self):
+        with CaptureQueriesContext(connection) as cold:
+            self.client.get('/pizza/hot/')
+        with CaptureQueriesContext(connection) as warm:
+            response = self.client.get('/pizza/hot/')
+        self.assertLess(len(warm), len(cold))
+        self.assertContains(response, '300&nbsp;Р')
+
+    def test_save_invalidates(self):
+        self.client.get('/pizza/hot/')
+        self.meal.price = 450
+        self.meal.save()
+        run_commit_hooks()
+        self.assertContains(self.client.get('/pizza/hot/'), '450&nbsp;Р')
+        SubSection.objects.create(link='cold', title='Холодная', sec=self.sec, img='subsec.jpg')
+        run_commit_hooks()
+        self.assertContains(self.client.get('/pizza/hot/'), 'Холодная')
+
+    def check_lru(self, cache):
+        for i in range(3):
+            cache.set('key%d' % i, 'value%d' % i)
+        self.assertEqual(cache.get('key0'), 'value0')
+        cache.set('key3', 'value3')
+        self.assertIsNone(cache.get('key1'))
+        self.assertEqual(cache.get('key0'), 'value0')
+
+    def test_locmem_lru(self):
+        self.check_lru(LocMemLRUCache(max_entries=3))
+
+    def test_file_lru(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        self.check_lru(FileLRUCache(location, max_entries=3))
+
+    def test_file_lru_lists_only_when_full(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        cache = FileLRUCache(location, max_entries=10)
+        with mock.patch('pizza_shop.fragments.os.listdir', wraps=os.listdir) as listdir:
+            for i in range(10):
+                cache.set('key%d' % i, 'value')
+                cache.set('key%d' % i, 'value')
+            # The first set counts the directory, overwrites and new files below the limit do not
+            self.assertEqual(listdir.call_count, 1)
+            cache.set('key10', 'value')
+            self.assertEqual(listdir.call_count, 2)
+        self.assertEqual(len(os.listdir(location)), 9)
+
+
+class PageShellCacheTest(CatalogTestCase):
+
+    def setUp(self):
+        fragment_cache().clear()
+
+    def assertTokenAccepted(self, client, response):
+        token = re.search(r"'csrfmiddlewaretoken': '(\w+)'", response.content.decode()).group(1)
+        response = client.post('/handler/', {'type': 'add', 'meal': 'margherita', 'csrfmiddlewaretoken': token},
+                               HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+
+    def test_anonymous_pages_served_from_shell(self):
+        self.assertEqual(self.client.get('/pizza/hot/margherita/')['X-Page-Cache'], 'miss')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/pizza/hot/margherita/')
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        self.assertEqual(len(queries), 0)
+
+        client, other = self.client_class(enforce_csrf_checks=True), self.client_class(enforce_csrf_checks=True)
+        response, other_response = client.get('/pizza/hot/margherita/'), other.get('/pizza/hot/margherita/')
+        self.assertEqual(other_response['X-Page-Cache'], 'hit')
+        self.assertNotEqual(client.cookies['csrftoken'].value, other.cookies['csrftoken'].value)
+        self.assertTokenAccepted(client, response)
+        self.assertTokenAccepted(other, other_response)
+
+    def test_shell_with_token_not_stored(self):
+        template = Template('{% csrf_token %}')
+        view = cache_page_shell(lambda request: HttpResponse(template.render(Context({'csrf_token': get_token(request)}))))
+        request = RequestFactory().get('/token/')
+        request.user = AnonymousUser()
+        request.session = {}
+        self.assertContains(view(request), 'csrfmiddlewaretoken')
+        self.assertIsNone(fragment_cache().get(page_cache_key(request)))
+
+    def test_cart_filled_per_user(self):
+        self.client.get('/pizza/hot/margherita/')
+        self.client.post('/handler/', {'type': 'add', 'meal': 'margherita'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        response = self.client.get('/pizza/hot/margherita/')
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        self.assertContains(response, 'id="cart-margherita"')
+        self.assertContains(response, 'Изменить')
+
+        other = self.client_class().get('/pizza/hot/margherita/')
+        self.assertEqual(other['X-Page-Cache'], 'hit')
+        self.assertContains(other, 'Ваша корзина пуста')
+        self.assertNotContains(other, 'Изменить')
+
+
+class ConditionalGetTest(CatalogTestCase):
+
+    def test_not_modified(self):
+        response = self.client.get('/pizza/')
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.client.get('/pizza/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(len(queries), 0)
+        cached = self.client.get('/pizza/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(cached.status_code, 304)
+
+    def test_validators_change(self):
+        etag = self.client.get('/pizza/hot/margherita/')['ETag']
+        self.client.post('/handler/', {'type': 'add', 'meal': 'margherita'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        response = self.client.get('/pizza/hot/margherita/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Изменить')
+
+        etag = response['ETag']
+        self.meal.price = 450
+        self.meal.save()
+        run_commit_hooks()
+        response = self.client.get('/pizza/hot/margherita/', HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, '450&nbsp;Р')
+
+
+class CartBatchTest(CatalogTestCase):
+
+    def post(self, ops):
+        return self.client.post('/handler/', {'type': 'batch', 'ops': ops}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def test_batch(self):
+        response = self.post('[{"type": "add", "meal": "margherita"}, {"type": "del", "meal": "salami"}]')
+        self.assertEqual(sorted(response.json()['lines']), ['margherita', 'salami'])
+        self.assertEqual(CartMeal.objects.get().amount, 1)
+
+    def test_malformed_operations(self):
+        for ops in ('[{"type": "add"}]', '[{"type": "del", "meal": ["margherita"]}]', '{"type": "add"}', '[1]'):
+            self.assertEqual(self.post(ops).content, b'ERROR')
+        self.assertFalse(CartMeal.objects.exists())
+
+    def test_set(self):
+        check_set(self)
+        self.assertEqual(CartMeal.objects.get().amount, 3)
+
+
+class CartApiTest(CatalogTestCase):
+
+    def add(self):
+        return self.client.post('/cart/', {'type': 'add', 'meal': 'margherita'}).json()
+
+    def test_not_modified(self):
+        etag = self.add()['etag']
+        response = self.client.get('/cart/')
+        self.assertEqual(response['ETag'], '"%s"' % etag)
+        self.assertEqual(self.client.get('/cart/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get('/cart/', {'version': etag}).status_code, 304)
+        self.assertEqual(self.client.get('/cart/', {'version': response.json()['version']}).status_code, 200)
+
+        self.add()
+        response = self.client.get('/cart/', {'version': etag}, HTTP_IF_NONE_MATCH='"%s"' % etag)
+        self.assertEqual(response.json()['total_amount'], 2)
+
+    def test_next_cart_after_checkout(self):
+        self.client.force_login(User.objects.create_user('amy', password='pw123456'))
+        order = self.add()
+        self.client.get('/accounts/order/')
+        cart = self.add()
+        # Same version number, another cart
+        self.assertEqual(cart['version'], order['version'])
+        self.assertEqual(self.client.get('/cart/', {'version': order['version']}).status_code, 200)
+        response = self.client.get('/cart/', {'version': order['etag']}, HTTP_IF_NONE_MATCH='"%s"' % order['etag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['etag'], cart['etag'])
+
+
+class PlaceholderCartTest(CatalogTestCase):
+
+    def test_no_row_until_first_add(self):
+        for url in ('/', '/pizza/', '/pizza/hot/', '/pizza/hot/margherita/', '/cart/'):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.client.post('/handler/', {'type': 'del', 'meal': 'margherita'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.client.post('/cart/', {'type': 'del', 'meal': 'margherita'})
+        self.assertEqual(Cart.objects.count(), 0)
+
+        self.client.post('/handler/', {'type': 'add', 'meal': 'margherita'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.client.get('/pizza/hot/margherita/')
+        self.client.post('/handler/', {'type': 'add', 'meal': 'margherita'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        cart = Cart.objects.get()
+        self.assertEqual((cart.total_amount, cart.cartmeal_set.get().amount), (2, 2))
+
+
+class MealSamplerTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(MealSamplerTest, cls).setUpTestData()
+        for i in range(5):
+            Meal.objects.create(link='meal%d' % i, title='Блюдо %d' % i, price=100, weight='300', subsec=cls.subsec)
+
+    def test_sample(self):
+        sampler = MealSampler()
+        for i in range(20):
+            meals = [meal.link for meal in sampler.sample(3, exclude=('margherita', 'meal0'))]
+            self.assertEqual(len(set(meals)), 3)
+            self.assertFalse({'margherita', 'meal0'} & set(meals))
+        self.assertEqual(len(sampler.sample(10)), 6)
+
+    def test_keys_loaded_once(self):
+        sampler = MealSampler()
+        with mock.patch.object(sampler, '_load', return_value=['margherita']) as load:
+            with sampler._lock:
+                threads = [threading.Thread(target=sampler.keys) for i in range(4)]
+                for thread in threads:
+                    thread.start()
+                # All of them saw no keys and wait for the lock
+                time.sleep(0.05)
+            for thread in threads:
+                thread.join()
+        self.assertEqual(load.call_count, 1)
+
+
+class OrderStatesTest(CatalogTestCase):
+
+    def setUp(self):
+        # The states an earlier test created were rolled back
+        order_states.clear()
+
+    def test_missing_state_recreated(self):
+        unpaid = order_states.id(OrderStates.UNPAID)
+        State.objects.filter(pk=unpaid).delete()
+        order_states.clear()
+        with self.assertNumQueries(2):
+            # Loaded, then the missing state created again
+            unpaid = order_states.id(OrderStates.UNPAID)
+        self.assertEqual(State.objects.get(pk=unpaid).text, OrderStates.DEFINITIONS[OrderStates.UNPAID][0])
+        self.assertEqual(State.objects.count(), len(OrderStates.DEFINITIONS))
+
+    def test_checkout_sets_unpaid(self):
+        self.client.force_login(User.objects.create_user('amy', password='pw123456'))
+        self.client.post('/handler/', {'type': 'add', 'meal': 'margherita'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(Cart.objects.get().status_id, order_states.id(OrderStates.PENDING))
+        with self.assertNumQueries(0):
+            order_states.id(OrderStates.UNPAID)
+        self.client.get('/accounts/order/')
+        cart = Cart.objects.get()
+        self.assertEqual((cart.archive, cart.status_id), (True, order_states.id(OrderStates.UNPAID)))
+
+
+class KeysetPaginationTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(KeysetPaginationTest, cls).setUpTestData()
+        for i in range(59):
+            Meal.objects.create(link='meal%02d' % i, title='Блюдо %d' % i, price=100 + i, weight='300',
+                                subsec=cls.subsec)
+        # Three dates for sixty meals, pages end in the middle of a tie
+        now = timezone.now()
+        for i, link in enumerate(Meal.objects.order_by('link').values_list('link', flat=True)):
+            Meal.objects.filter(link=link).update(add_date=now - timezone.timedelta(days=i % 3))
+        bump_catalog_version()
+        cls.links = list(Meal.objects.order_by(*MEAL_ORDERING).values_list('link', flat=True))
+
+    def walk(self, meals, per_page):
+        links, cursor = [], ''
+        while True:
+            page = keyset_page(meals, cursor, per_page)
+            links.extend(meal.link for meal in page)
+            if not page.has_next():
+                return links
+            cursor = page.next_cursor
+
+    def test_querysets_and_snapshot_lists(self):
+        for per_page in (4, 7, 30):
+            self.assertEqual(self.walk(Meal.objects.all(), per_page), self.links)
+            self.assertEqual(self.walk(catalog_snapshot().section_meals('pizza'), per_page), self.links)
+
+    def test_section_pages(self):
+        # The numbered first page, then keyset pages after its last meal
+        first = list(self.client.get('/pizza/').context['meals'])
+        links, url = [meal.link for meal in first], '/pizza/?after=%s' % encode_cursor(first[-1].add_date, first[-1].link)
+        while url:
+            response = self.client.get(url)
+            meals = response.context['meals']
+            links.extend(meal.link for meal in meals)
+            url = '/pizza/?after=%s' % meals.next_cursor if meals.has_next() else None
+            if url:
+                self.assertContains(response, 'href="?after=%s"' % meals.next_cursor)
+        self.assertEqual(links, self.links)
+        self.assertEqual(len(links), MEALS_PER_PAGE * 2 + 12)
+
+    def test_malformed_cursor(self):
+        for cursor in ('garbage', '!!!', base64.urlsafe_b64encode(b'yesterday~meal01').decode()):
+            response = self.client.get('/pizza/', {'after': cursor})
+            self.assertEqual([meal.link for meal in response.context['meals']], self.links[:MEALS_PER_PAGE])
+            self.assertEqual([meal.link for meal in keyset_page(Meal.objects.all(), cursor, 4)], self.links[:4])
+
+
+class OrderHistoryTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(OrderHistoryTest, cls).setUpTestData()
+        cls.user = User.objects.create_user('amy', password='pw123456')
+        for i in range(3):
+            Cart.objects.create(owner=cls.user, archive=True)
+
+    def test_pages(self):
+        first = order_history(self.user, per_page=2)
+        self.assertTrue(first.has_next())
+        rest = order_history(self.user, first.next_cursor, per_page=2)
+        self.assertEqual(len(rest), 1)
+        self.assertFalse(set(order.pk for order in first) & set(order.pk for order in rest))
+
+    def test_foreign_cursor(self):
+        # The cursor of a meal list carries a link where orders have an id
+        cursor = encode_cursor(timezone.now(), 'margherita')
+        self.assertEqual(len(order_history(self.user, cursor)), 3)
+        self.client.login(username='amy', password='pw123456')
+        self.assertEqual(self.client.get('/accounts/', {'before': cursor}).status_code, 200)
+
+
+class CatalogSnapshotTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(CatalogSnapshotTest, cls).setUpTestData()
+        cold = SubSection.objects.create(link='cold', title='cold', sec=cls.sec, img='subsec.jpg')
+        for subsec in (cls.subsec, cold):
+            for i in range(3):
+                meal = Meal.objects.create(link='%s%d' % (subsec.link, i), title='%s %d' % (subsec.link, i),
+                                           weight='500', subsec=subsec)
+                MealImage.objects.create(meal=meal, img='%s.jpg' % meal.link)
+        salami = Ingredient.objects.create(title='Салями', type=IngredientType.objects.create(title='Мясо'))
+        salami.inside.add('hot0')
+
+    def test_fixed_number_of_queries(self):
+        catalog_snapshot()
+        Meal.objects.create(link='hot9', title='hot 9', weight='500', subsec_id='hot')
+        run_commit_hooks()
+        with self.assertNumQueries(7):
+            snapshot = catalog_snapshot()
+        self.assertEqual([meal.link for meal in snapshot.subsection_meals('hot')][0], 'hot9')
+        self.assertEqual(len(snapshot.section_meals('pizza')), 8)
+        self.assertIs(catalog_snapshot(), snapshot)
+
+    def test_readers_do_not_wait_for_rebuild(self):
+        old = catalog_snapshot()
+        bump_catalog_version()
+        # As if another thread were building the new snapshot
+        with _snapshot_lock, self.assertNumQueries(0):
+            self.assertIs(catalog_snapshot(), old)
+        self.assertIsNot(catalog_snapshot(), old)
+
+    def test_records(self):
+        meal = catalog_snapshot().meals['hot0']
+        self.assertEqual(meal.subsec.sec.link, 'pizza')
+        self.assertEqual([str(ing) for ing in meal.ingredients.all()], ['Салями'])
+        self.assertEqual(meal.main_img.url(), '/media/hot0.jpg')
+        with self.assertRaises(AttributeError):
+            meal.price = 1
+
+    def test_pages_read_snapshot(self):
+        # Warm the per-process caches: snapshot, order states, sampler keys
+        self.client.get('/pizza/hot/hot1/')
+        fragment_cache().clear()
+        with self.assertNumQueries(0):
+            self.client.get('/pizza/hot/hot1/')
+            self.client.get('/pizza/')
+
+
+class CatalogVersionTest(TransactionTestCase):
+
+    def test_bumped_after_commit(self):
+        sec, subsec, meal = create_catalog()
+        version = catalog_version()
+        with transaction.atomic():
+            meal.price = 450
+            meal.save()
+            # Another request rebuilding the caches now would read the old price under the new version
+            self.assertEqual(catalog_version(), version)
+        self.assertNotEqual(catalog_version(), version)
+
+        version = catalog_version()
+        with self.assertRaises(ValueError), transaction.atomic():
+            meal.delete()
+            raise ValueError
+        self.assertEqual(catalog_version(), version)
+
+
+def get_metrics(client):
+    with override_settings(METRICS_TOKEN='scraper'):
+        return client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scraper')
+
+
+@override_settings(METRICS_QUERIES=True)
+class RequestMetricsTest(CatalogTestCase):
+
+    def setUp(self):
+        request_metrics.clear()
+
+    def test_metrics_endpoint(self):
+        self.client.get('/pizza/hot/')
+        self.client.post('/handler/', {'type': 'add', 'meal': 'margherita'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        response = get_metrics(self.client)
+        self.assertContains(response, 'pizza_request_seconds_count{view="subsection"} 1')
+        self.assertContains(response, 'pizza_request_queries_count{view="handler:add"} 1')
+        self.assertContains(response, 'pizza_requests_total{view="subsection",status="200"} 1')
+
+    def test_access(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 404)
+        with self.settings(METRICS_TOKEN='scraper'):
+            self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer forged').status_code, 404)
+        User.objects.create_user('staff', password='pw123456', is_staff=True)
+        self.client.login(username='staff', password='pw123456')
+        self.assertEqual(self.client.get('/metrics/').status_code, 200)
+
+    def test_labels_are_bounded(self):
+        for req_type in ('x1', 'x2', 'x"}\n'):
+            self.client.post('/handler/', {'type': req_type}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertContains(get_metrics(self.client), 'pizza_requests_total{view="handler:other",status="200"} 3')
+        self.assertEqual(label_value('a"b\\c\nd'), 'a\\"b\\\\c\\nd')
+
+    def test_queries_opt_in(self):
+        with self.settings(METRICS_QUERIES=False):
+            self.client.get('/pizza/hot/')
+        self.assertContains(get_metrics(self.client), 'pizza_request_queries_count{view="subsection"} 0')
+
+    def test_query_budget(self):
+        with self.settings(METRICS_QUERY_BUDGET=0), self.assertLogs('pizza_shop.metrics', 'WARNING') as logs:
+            self.client.post('/handler/', {'type': 'add', 'meal': 'margherita'},
+                             HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertIn('handler:add', logs.output[0])
+        self.assertContains(get_metrics(self.client),
+                            'pizza_requests_over_query_budget_total{view="handler:add"} 1')
+
+
+class BenchmarkTest(TestCase):
+
+    def test_generate_and_run(self):
+        generate_dataset(seed=3, sections=1, subsections=2, meals=3, images=1, ingredients=4, users=3, carts=10,
+                         lines=2)
+        self.assertEqual(Meal.objects.filter(link__startswith='bench').count(), 6)
+        self.assertEqual(CartMeal.objects.filter(cart__token__startswith='BENCH').count(), 20)
+
+        report = run_benchmark(['catalog', 'cart', 'account'], clients=1, requests=3, warmup=1)
+        for stats in report.values():
+            self.assertEqual(stats['requests'], 3)
+            self.assertEqual(stats['errors'], 0)
+        slower = dict((name, dict(stats, p95_ms=stats['p95_ms'] * 2 + 10)) for name, stats in report.items())
+        self.assertEqual(compare_reports(report, report), [])
+        self.assertEqual(len(compare_reports(report, slower)), 3)
+
+        clear_dataset()
+        self.assertFalse(Meal.objects.filter(link__startswith='bench').exists())
+
+
+class ProfilingTest(CatalogTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_sampler(self):
+        def busy():
+            deadline = time.time() + 0.05
+            while time.time() < deadline:
+                pass
+        sampler = StackSampler(threading.get_ident(), 0.001).start()
+        busy()
+        stacks = sampler.stop()
+        self.assertTrue(stacks)
+        self.assertTrue(any(stack.endswith('pizza_shop/tests.py:busy') for stack in stacks))
+
+    def test_signed_header(self):
+        with self.settings(PROFILE_DIR=self.dir, PROFILE_INTERVAL=0.0001, PROFILE_SAMPLE_RATE=0):
+            self.client.get('/pizza/hot/', HTTP_X_PROFILE='forged')
+            self.assertEqual(os.listdir(self.dir), [])
+            fragment_cache().clear()
+            self.client.get('/pizza/hot/', HTTP_X_PROFILE=profile_token())
+        stacks = read_collapsed(os.path.join(self.dir, 'subsection.collapsed'))
+        self.assertTrue(stacks)
+        self.assertTrue(all(' ' not in stack for stack in stacks))
+
+
+class QueryLogTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(QueryLogTest, cls).setUpTestData()
+        Meal.objects.create(link='salami', title='Салями', price=300, weight='500', subsec=cls.subsec)
+
+    def setUp(self):
+        query_stats.clear()
+
+    def test_duplicates_point_at_template(self):
+        # A lazy relation in a loop, one subsection query per meal
+        template = Template('{% for meal in meals %}\n{{ meal.subsec.title }}{% endfor %}',
+                            origin=Origin('probe.html', template_name='probe.html'))
+        middleware = QueryLogMiddleware()
+        request = RequestFactory().get('/')
+        with self.settings(QUERYLOG_DUPLICATES=2), self.assertLogs('pizza_shop.querylog', 'WARNING') as logs:
+            middleware.process_request(request)
+            template.render(Context({'meals': Meal.objects.all()}))
+            middleware.process_response(request, HttpResponse())
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Query repeated 2 times in unresolved at probe.html:2', logs.output[0])
+        self.assertIn('pizza_shop/tests.py', logs.output[0])
+        self.assertContains(get_metrics(self.client), 'pizza_problem_query_origins_total'
+                            '{view="unresolved",kind="duplicate",location="probe.html:2"} 1')
+
+    def test_slow_queries(self):
+        with self.settings(QUERYLOG_SLOW_MS=0, QUERYLOG_DUPLICATES=None), \
+                self.assertLogs('pizza_shop.querylog', 'WARNING') as logs:
+            self.client.post('/handler/', {'type': 'add', 'meal': 'margherita'},
+                             HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertTrue(all('Slow query' in line and 'handler:add' in line for line in logs.output))
+
+
+class SerializedWriteTest(TransactionTestCase):
+
+    def test_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_retries_when_locked(self):
+        attempts = []
+
+        @serialized_write
+        def write():
+            attempts.append(connection.in_atomic_block)
+            IngredientType.objects.create(title='type %d' % len(attempts))
+            if len(attempts) < 3:
+                raise OperationalError('database is locked')
+
+        with self.settings(WRITE_RETRY_DELAY=0):
+            write()
+        self.assertEqual(attempts, [True] * 3)
+        # The failed attempts were rolled back
+        self.assertEqual(list(IngredientType.objects.values_list('title', flat=True)), ['type 3'])
+
+        @serialized_write
+        def broken():
+            raise OperationalError('no such table: nope')
+        with self.assertRaises(OperationalError):
+            broken()
+
+    def test_is_locked(self):
+        self.assertTrue(is_locked(OperationalError('database is locked')))
+        self.assertTrue(is_locked(OperationalError('database table is locked: pizza_shop_cart')))
+        self.assertFalse(is_locked(OperationalError('no such column: pizza_shop_cart.locked')))
+        self.assertFalse(is_locked(OperationalError('no such table: busy_hours')))
+
+
+class CatalogReplicaTest(TransactionTestCase):
+
+    def setUp(self):
+        create_catalog()
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'replica.sqlite3')
+        call_command('sync_replica', path=self.path, stdout=io.StringIO())
+        connections.databases['replica'] = dict(connections.databases['default'], NAME=self.path, CONN_MAX_AGE=0,
+                                                OPTIONS={'pragmas': {'journal_mode': 'DELETE', 'query_only': 'ON'}})
+        self.addCleanup(self.remove_replica)
+
+    def remove_replica(self):
+        connections['replica'].close()
+        del connections.databases['replica']
+        del connections._connections.replica
+
+    def test_reads_follow_writes(self):
+        Meal.objects.filter(link='margherita').update(title='Новая')
+        reset_sticky()
+        meal = Meal.objects.get(link='margherita')
+        self.assertEqual((meal._state.db, meal.title), ('replica', 'Маргарита'))
+
+        # A cart line may point at a meal read from the replica
+        cart = Cart.objects.create()
+        CartMeal.objects.create(cart=cart, meal=meal, amount=1, price=meal.price)
+        self.assertEqual(Meal.objects.get(link='margherita').title, 'Новая')
+        reset_sticky()
+        with self.assertRaises(OperationalError):
+            Meal.objects.using('replica').filter(link='margherita').update(title='x')
+
+    def test_snapshot_of_edit_before_sync(self):
+        self.assertEqual(catalog_snapshot().meals['margherita'].price, 300)
+        meal = Meal.objects.get(link='margherita')
+        meal.price = 450
+        meal.save()
+        reset_sticky()
+        # The replica lags until the next sync, the snapshot kept under the new version does not
+        self.assertEqual(Meal.objects.get(link='margherita').price, 300)
+        self.assertEqual(catalog_snapshot().meals['margherita'].price, 450)
+
+        call_command('sync_replica', path=self.path, stdout=io.StringIO())
+        # What the end of a request does, the replica connection is not kept
+        close_old_connections()
+        self.assertEqual(Meal.objects.get(link='margherita').price, 450)
+        self.assertEqual(catalog_snapshot().meals['margherita'].price, 450)
+
+
+@override_settings(CART_STORE='cache', CART_STORE_FLUSH_INTERVAL=3600)
+class LiveCartStoreTest(CatalogTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(LiveCartStoreTest, cls).setUpTestData()
+        Meal.objects.create(link='salami', title='Салями', price=400, weight='500', subsec=cls.subsec)
+        User.objects.create_user('amy', password='pw123456')
+
+    def setUp(self):
+        caches['carts'].clear()
+        fragment_cache().clear()
+
+    def post(self, data):
+        return self.client.post('/handler/', data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def test_clicks_write_nothing(self):
+        self.post({'type': 'add', 'meal': 'margherita'})
+        with CaptureQueriesContext(connection) as queries:
+            self.post({'type': 'add', 'meal': 'margherita'})
+            self.post({'type': 'set', 'meal': 'salami', 'amount': 2})
+            response = self.client.get('/pizza/hot/margherita/')
+        self.assertEqual([query['sql'] for query in queries if not query['sql'].startswith('SELECT')], [])
+        self.assertContains(response, 'value="2"')
+        self.assertContains(response, 'id="cart-salami"')
+        self.assertFalse(Cart.objects.exists())
+
+        self.assertEqual(self.post({'type': 'batch', 'ops': '[{"type": "del", "meal": "salami"}, {"type": "x"}]'})
+                         .content, b'ERROR')
+        self.assertEqual(self.client.get('/cart/').json()['total_price'], 1400)
+
+        self.assertEqual(flush_live_carts(), 1)
+        cart = Cart.objects.get()
+        self.assertEqual((cart.owner, cart.total_amount, cart.total_price), (None, 4, 1400))
+        self.assertEqual(sorted(cart.cartmeal_set.values_list('meal_id', 'amount')), [('margherita', 2), ('salami', 2)])
+
+    def test_login_and_checkout(self):
+        self.post({'type': 'add', 'meal': 'salami'})
+        self.client.post('/accounts/login/', {'username': 'amy', 'password': 'pw123456'})
+        cart = Cart.objects.get()
+        self.assertEqual((cart.owner.username, cart.total_price), ('amy', 400))
+
+        self.post({'type': 'add', 'meal': 'margherita'})
+        self.assertEqual(Cart.objects.get().total_price, 400)
+        self.client.get('/accounts/order/')
+        cart = Cart.objects.get()
+        self.assertEqual((cart.archive, cart.total_price, cart.cartmeal_set.count()), (True, 700, 2))
+        self.assertEqual(self.client.get('/cart/').json()['lines'], [])
+
+    def test_lock(self):
+        self.post({'type': 'add', 'meal': 'margherita'})
+        token = self.client.session['cart_token']
+        with cart_lock(token), mock.patch('pizza_shop.cartstore.LOCK_TIMEOUT', 0.05):
+            # The click fails instead of overwriting the state, the holder keeps its lock
+            self.assertEqual(self.post({'type': 'add', 'meal': 'margherita'}).content, b'ERROR')
+            self.assertIsNotNone(caches['carts'].get(LOCK_KEY % token))
+        self.assertIsNone(caches['carts'].get(LOCK_KEY % token))
+        self.assertEqual(self.client.get('/cart/').json()['total_amount'], 1)
+
+        with cart_lock(token):
+            # Expired and taken over by another request meanwhile
+            caches['carts'].set(LOCK_KEY % token, 'other')
+        self.assertEqual(caches['carts'].get(LOCK_KEY % token), 'other')
+        with mock.patch('pizza_shop.cartstore.LOCK_TIMEOUT', 0.05), self.assertRaises(CartLocked):
+            with cart_lock(token):
+                pass
+
+    def test_set(self):
+        check_set(self)
+        self.assertFalse(CartMeal.objects.exists())
+
+    def test_written_carts_expire(self):
+        with self.settings(CART_STORE_TIMEOUT=0):
+            self.post({'type': 'add', 'meal': 'salami'})
+            token = self.client.session['cart_token']
+            # Not written yet, the cache holds the only copy
+            self.assertIsNotNone(caches['carts'].get(STATE_KEY % token))
+            flush_live_carts()
+            self.assertIsNone(caches['carts'].get(STATE_KEY % token))
+            self.assertEqual(self.client.get('/cart/').json()['total_price'], 400)
+
+    def test_cache_check(self):
+        self.assertEqual([error.id for error in check_cart_cache()], ['pizza_shop.E001'])
+        with self.settings(CART_STORE='db'):
+            self.assertEqual(check_cart_cache(), [])
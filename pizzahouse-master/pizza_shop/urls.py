@@ -1,5 +1,6 @@
 from django.conf.urls import url
 from pizza_shop import views
+from pizza_shop.metrics import metrics
 
 urlpatterns = [
     url(r'^$', views.index, name='main'),
@@ -14,6 +15,8 @@ urlpatterns = [
     url(r'^about/$', views.about, name='about'),
 
     url(r'^handler/$', views.ajax_handler, name='handler'),
+    url(r'^cart/$', views.cart_api, name='cart'),
+    url(r'^metrics/$', metrics, name='metrics'),
 
     url(r'^(?P<link>[0-9a-zA-Z_-]*)/$', views.section, name='section'),
     url(r'^(?P<link>[0-9a-zA-Z_-]*)/(?P<sublink>[0-9a-zA-Z_-]*)/$', views.subsection, name='subsection'),
@@ -1,83 +1,66 @@
-import operator
-from functools import reduce
+import json
 
 from django.contrib.auth import authenticate, REDIRECT_FIELD_NAME, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.views import deprecate_current_app
 from django.contrib.sites.shortcuts import get_current_site
-from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.core.urlresolvers import reverse
-from django.db.models import Q
-from django.http import HttpResponse, HttpResponseRedirect
-from django.shortcuts import render, get_object_or_404, render_to_response, resolve_url
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, HttpResponseNotModified, Http404
+from django.shortcuts import render, render_to_response, resolve_url
 from django.template import RequestContext
 from django.template.loader import render_to_string
 from django.template.response import TemplateResponse
-from django.utils.http import is_safe_url
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.functional import SimpleLazyObject
+from django.utils.http import is_safe_url, parse_etags, quote_etag
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_protect, csrf_exempt
 from django.views.decorators.debug import sensitive_post_parameters
 from paypal.standard.forms import PayPalPaymentsForm
 
+from pizza_shop.cart import get_request_cart, forget_cart, change_cart, change_cart_batch, adopt_cart, \
+    save_request_cart, cart_etag, cart_json, line_json
+from pizza_shop.cartstore import CartLocked
 from pizza_shop.forms import UserRegForm, ContactForm
-from pizza_shop.models import Meal, Section, SubSection, Cart, CartMeal, State
+from pizza_shop.models import Cart, OrderStates, order_states
+from pizza_shop.orders import order_history
+from pizza_shop.pagecache import cache_page_shell, catalog_condition
+from pizza_shop.pagination import paginate_meals
+from pizza_shop.sampling import meal_sampler
+from pizza_shop.search import search_index
+from pizza_shop.snapshot import catalog_snapshot
 from pizzaproject import settings
 
 
-def get_cart(request):
-    found = False
-
-    if request.session.get('cart_token', ''):
-        cart = Cart.objects.filter(token=request.session['cart_token']).latest('creation_date')
-        if cart.archive is False and (
-                (request.user.is_authenticated() and cart.owner == request.user) or request.user.is_anonymous()):
-            found = True
-    elif request.user.is_authenticated() and request.user.carts.filter(archive=False).all():
-            cart = request.user.carts.filter(archive=False).latest('creation_date')
-            found = True
-    if not found:
-        cart = Cart()
-        if request.user.is_authenticated():
-            cart.owner = request.user
-        cart.save()
-    request.session['cart_token'] = cart.token
-    return cart
-
-
 def menu(request):
-    reg_form = UserRegForm()
-    phone_form = ContactForm()
+    # Everything here is lazy: nothing is queried, created or instantiated
+    # until a template actually touches it
     return {
-        'sects': Section.objects.all(),
-        'cart': get_cart(request),
-        'form': AuthenticationForm(),
-        'phone_form': phone_form,
-        'reg_form': reg_form,
+        'sects': SimpleLazyObject(lambda: catalog_snapshot().section_list),
+        'cart': SimpleLazyObject(lambda: get_request_cart(request)),
+        'form': SimpleLazyObject(AuthenticationForm),
+        'phone_form': SimpleLazyObject(ContactForm),
+        'reg_form': SimpleLazyObject(UserRegForm),
     }
 
 
+@catalog_condition(lambda catalog: catalog.meals.values())
+@cache_page_shell
 def index(request):
-    meals = Meal.objects.order_by('?').all()[:9]
+    snapshot = catalog_snapshot()
+    meals = [snapshot.meals[link] for link in meal_sampler.sample_keys(9) if link in snapshot.meals]
     return render(request, 'index.html', {'meals': meals, 'title': 'Главная'})
 
 
+@catalog_condition(lambda catalog, link: catalog.section_meals(link))
+@cache_page_shell
 def section(request, link):
-    sec = get_object_or_404(Section, link=link)
-    objs = []
-    for ss in sec.subsecs.all():
-        objs.extend(ss.meals.all())
-    paginator = Paginator(objs, 24)  # Show 24 meals per page
-
-    page = request.GET.get('page')
-    try:
-        meals = paginator.page(page)
-    except PageNotAnInteger:
-        # If page is not an integer, deliver first page.
-        meals = paginator.page(1)
-    except EmptyPage:
-        # If page is out of range (e.g. 9999), deliver last page of results.
-        meals = paginator.page(paginator.num_pages)
+    snapshot = catalog_snapshot()
+    sec = snapshot.sections.get(link)
+    if sec is None:
+        raise Http404('No section %s' % link)
+    meals = paginate_meals(request, snapshot.section_meals(link))
     context = {'meals': meals,
                'section': sec,
                'title': str(sec),
@@ -85,20 +68,13 @@ def section(request, link):
     return render(request, 'section.html', context)
 
 
+@catalog_condition(lambda catalog, sublink, **kwargs: catalog.subsection_meals(sublink))
+@cache_page_shell
 def subsection(request, link, sublink):
-    subsec = get_object_or_404(SubSection, link=sublink)
-    objs = subsec.meals.all()
-    paginator = Paginator(objs, 24)  # Show 24 meals per page
-
-    page = request.GET.get('page')
-    try:
-        meals = paginator.page(page)
-    except PageNotAnInteger:
-        # If page is not an integer, deliver first page.
-        meals = paginator.page(1)
-    except EmptyPage:
-        # If page is out of range (e.g. 9999), deliver last page of results.
-        meals = paginator.page(paginator.num_pages)
+    subsec = catalog_snapshot().subsections.get(sublink)
+    if subsec is None:
+        raise Http404('No subsection %s' % sublink)
+    meals = paginate_meals(request, subsec.meals)
     context = {'meals': meals,
                'subsection': subsec,
                'title': str(subsec.sec) + str(subsec),
@@ -106,18 +82,19 @@ def subsection(request, link, sublink):
     return render(request, 'subsection.html', context)
 
 
+@catalog_condition(lambda catalog, meal_link, **kwargs: filter(None, [catalog.meals.get(meal_link)]))
+@cache_page_shell
 def meal(request, link, sublink, meal_link):
-    meal = get_object_or_404(Meal, link=meal_link)
-    try:
-        in_cart = get_cart(request).cartmeal_set.get(meal=meal).amount
-    except Exception:
-        in_cart = 0
-    rand_meals = Meal.objects.exclude(link=meal.link).order_by('?')[:3]
+    snapshot = catalog_snapshot()
+    meal = snapshot.meals.get(meal_link)
+    if meal is None:
+        raise Http404('No meal %s' % meal_link)
+    rand_meals = [snapshot.meals[link] for link in meal_sampler.sample_keys(3, exclude=(meal.link,))
+                  if link in snapshot.meals]
     return render(request, 'show.html', {'meal': meal,
                                          'meals': rand_meals,
                                          'section': meal.subsec.sec,
                                          'subsection': meal.subsec,
-                                         'in_cart': in_cart,
                                          'title': str(meal),
                                          })
 
@@ -130,51 +107,93 @@ def ajax_handler(request):
     if request.is_ajax():
         req_type = request.POST.get('type')
         if req_type == 'add' or req_type == 'set':
-            cart = get_cart(request)
+            cart = get_request_cart(request, create=True, with_lines=False)
             try:
-                _meal = Meal.objects.get(link=request.POST.get('meal'))
-            except Meal.DoesNotExist:
+                cart_meal = change_cart(cart, request.POST)
+            except (ValueError, CartLocked):
                 return HttpResponse("ERROR")
-
-            try:
-                cart_meal = cart.cartmeal_set.get(meal=_meal)
-            except CartMeal.DoesNotExist:
-                cart_meal = CartMeal.objects.create(cart=cart, meal=_meal, amount=0)
-            if req_type == 'set':
-                amount = request.POST.get('amount')
-                if amount:
-                    cart_meal.amount = int(amount)
-            else:
-                cart_meal.amount += 1
-            cart_meal.save()
-            cart.save()
+            if cart_meal is None:
+                # Unknown meal for add, a zero amount for set removes the line
+                return HttpResponse("ERROR" if req_type == 'add' else '')
             return HttpResponse(render_to_string('ajax/cart_meal.html', {'cart_meal': cart_meal}))
 
         elif req_type == 'del':
-            cart = get_cart(request)
-            try:
-                _meal = Meal.objects.get(link=request.POST.get('meal'))
-                cart_meal = cart.cartmeal_set.get(meal=_meal)
-                cart_meal.delete()
-                cart.save()
-            except Meal.DoesNotExist or CartMeal.DoesNotExist:
-                pass
+            cart = get_request_cart(request, with_lines=False)
+            if cart.pk is not None:
+                try:
+                    change_cart(cart, request.POST)
+                except CartLocked:
+                    return HttpResponse("ERROR")
             return HttpResponse('OK')
 
+        elif req_type == 'batch':
+            # ops: JSON list of {"type": "add"|"set"|"del", "meal": link, "amount": n}
+            try:
+                operations = json.loads(request.POST.get('ops', ''))
+                # The answer is keyed by meal, every operation needs one
+                if not isinstance(operations, list) or not all(
+                        isinstance(operation, dict) and isinstance(operation.get('meal'), str)
+                        for operation in operations):
+                    raise ValueError('ops must be a list of operations on a meal')
+                cart = get_request_cart(request, create=True, with_lines=False)
+                lines = change_cart_batch(cart, operations)
+            except (ValueError, TypeError, AttributeError, CartLocked):
+                return HttpResponse("ERROR")
+            return JsonResponse({'lines': dict(
+                (operation['meal'], render_to_string('ajax/cart_meal.html', {'cart_meal': cart_meal})
+                 if cart_meal is not None else '')
+                for operation, cart_meal in zip(operations, lines)
+            )})
+
         elif req_type == 'search':
-            wordlist = request.POST.get('meal').split()
-            w = list()
-            for word in wordlist:
-                w.append(Q(title__icontains=word.strip()))
-            meals = Meal.objects.filter(reduce(operator.or_, w))
+            links = search_index.search(request.POST.get('meal', ''))
+            snapshot = catalog_snapshot()
+            meals = [snapshot.meals[link] for link in links if link in snapshot.meals]
             return HttpResponse(render_to_string('search_output.html', {'meals': meals}))
 
     return HttpResponse('ERROR')
 
 
+def cart_api(request):
+    """
+    JSON cart endpoint.
+    GET returns the whole cart, or 304 when If-None-Match (or ?version=, with the 'etag' of an earlier
+    answer) already names this cart and version.
+    POST applies one add/set/del operation, or a JSON list of them in 'ops', and returns only
+    the changed lines (amount 0 for a line that is gone) with the new totals and version.
+    """
+    if request.method == 'POST':
+        try:
+            operations = json.loads(request.POST['ops']) if 'ops' in request.POST else [request.POST]
+            create = any(operation.get('type') != 'del' for operation in operations)
+            cart = get_request_cart(request, create=create, with_lines=False)
+            lines = change_cart_batch(cart, operations) if cart.pk is not None else [None] * len(operations)
+        except (ValueError, TypeError, AttributeError):
+            return JsonResponse({'error': 'Wrong operation'}, status=400)
+        except CartLocked:
+            return JsonResponse({'error': 'Cart is busy, try again'}, status=503)
+        if cart.pk is not None:
+            cart.refresh_from_db(fields=['version', 'total_amount', 'total_price'])
+        changed = [line_json(cart_meal) if cart_meal is not None else {'meal': operation.get('meal'), 'amount': 0}
+                   for operation, cart_meal in zip(operations, lines)]
+        response = JsonResponse(cart_json(cart, changed))
+    else:
+        cart = get_request_cart(request, with_lines=False)
+        etag = cart_etag(cart)
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')) or request.GET.get('version') == etag:
+            response = HttpResponseNotModified()
+        else:
+            lines = [line_json(cart_meal) for cart_meal in cart.cartmeal_set.select_related('meal__subsec')]
+            response = JsonResponse(cart_json(cart, lines))
+        response['ETag'] = quote_etag(etag)
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+
 @login_required
 def account(request):
-    old_orders = request.user.carts.filter(archive=True)
+    old_orders = order_history(request.user, request.GET.get('before'))
     return render(request, 'account.html', {'orders': old_orders, 'title': 'Ваш Профиль'})
 
 
@@ -214,10 +233,7 @@ def register(request):
             profile.save()
 
             new_user = authenticate(email=user_form.cleaned_data['email'], password=user_form.cleaned_data['password'])
-            if request.session.get('cart_token', ''):
-                cart = get_cart(request)
-                cart.owner = user
-                cart.save()
+            adopt_cart(request, user)
             login(request, new_user)
             next_page = request.GET.get('next')
             if next_page:
@@ -251,16 +267,17 @@ def register(request):
 def get_order(request):
     if not request.user.is_authenticated():
         return HttpResponseRedirect('/accounts/register')
+    save_request_cart(request)
     # if request.session.get('cart_token', '') != '':
     try:
-        cart = request.user.carts.filter(archive=False, token=request.session['cart_token']).latest('creation_date')
+        cart = request.user.carts.filter(archive=False, token=request.session.get('cart_token', '')).latest('creation_date')
         # print(cart.status)
         cart.archive = True
-        cart.status = State.objects.get_or_create(text='Не оплачен', details='Оплатите заказ')[0]
+        cart.status_id = order_states.id(OrderStates.UNPAID)
         cart.save()
     except Cart.DoesNotExist:
         pass
-    request.session['cart_token'] = ''
+    forget_cart(request)
     return HttpResponseRedirect('/accounts/')
 
 
@@ -286,12 +303,8 @@ def login_user(request, template_name='registration/login.html',
             if not is_safe_url(url=redirect_to, host=request.get_host()):
                 redirect_to = resolve_url(settings.LOGIN_REDIRECT_URL)
 
-            if request.session.get('cart_token', ''):
-                cart = get_cart(request)
-                if cart.cartmeal_set.all():
-                    cart.owner = form.get_user()
-                    cart.save()
-                
+            adopt_cart(request, form.get_user(), only_filled=True)
+
             # Okay, security check complete. Log the user in.
             login(request, form.get_user())
 
@@ -317,10 +330,11 @@ def login_user(request, template_name='registration/login.html',
 def logout_user(request):
     try:
         request.user.carts.filter(archive=False, token=request.session['cart_token']).latest('creation_date').delete()
-        request.session['cart_token'] = ''
-        logout(request)
     except Exception:
         pass
+    # Also drops a cart that only lives in the cart store
+    forget_cart(request)
+    logout(request)
     return HttpResponseRedirect('/')
 
 
@@ -328,7 +342,7 @@ def logout_user(request):
 def paypal_success(request, cart):
     if request.method == 'post':
         curr_cart = Cart.objects.get(id=cart)
-        curr_cart.status = State.objects.get_or_create(text='Оплачено', details='Спасибо за покупку')[0]
+        curr_cart.status_id = order_states.id(OrderStates.PAID)
         curr_cart.save()
     return HttpResponseRedirect('/accounts/')
 
@@ -37,7 +37,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'pizza_shop',
+    'pizza_shop.apps.PizzaShopConfig',
     'social.apps.django_app.default',
     'paypal.standard.ipn',
 ]
@@ -48,6 +48,10 @@ AUTHENTICATION_BACKENDS = (
 )
 
 MIDDLEWARE_CLASSES = [
+    # First, so the timings cover the other middleware too
+    'pizza_shop.metrics.RequestMetricsMiddleware',
+    'pizza_shop.profiling.ProfilingMiddleware',
+    'pizza_shop.querylog.QueryLogMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -86,11 +90,33 @@ WSGI_APPLICATION = 'pizzaproject.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        # SQLite in WAL mode with tuned pragmas, see pizza_shop/sqlite_wal/base.py
+        'ENGINE': 'pizza_shop.sqlite_wal',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'CONN_MAX_AGE': 60,
+        'OPTIONS': {
+            # Seconds a connection waits for the write lock before "database is locked"
+            'timeout': 5,
+        },
     }
 }
 
+# Read-only copy of the primary made by `manage.py sync_replica` (run it from cron), catalog reads go there
+# once it exists. Carts, orders and sessions stay on the primary, see pizza_shop/routers.py. Replica
+# connections are closed after every request, a kept one would go on reading the file sync_replica replaced.
+CATALOG_REPLICA = os.path.join(BASE_DIR, 'catalog_replica.sqlite3')
+if os.path.exists(CATALOG_REPLICA):
+    DATABASES['replica'] = dict(DATABASES['default'], NAME=CATALOG_REPLICA, CONN_MAX_AGE=0, OPTIONS={
+        'timeout': 5,
+        'pragmas': {'journal_mode': 'DELETE', 'query_only': 'ON'},
+    }, TEST={'MIRROR': 'default'})
+
+DATABASE_ROUTERS = ['pizza_shop.routers.CatalogReplicaRouter']
+
+# pizza_shop.database.serialized_write retries a transaction this often when the database stays locked
+WRITE_RETRIES = 3
+WRITE_RETRY_DELAY = 0.05
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
@@ -136,8 +162,10 @@ STATIC_URL = '/static/'
 STATICFILES_DIRS = (
     os.path.join(BASE_DIR, "static"),
 )
-#
-# STATIC_ROOT = '/opt/myenv/loffilab/collected_static'
+
+# Filled by manage.py build_static: hashed names plus .gz/.br copies
+STATIC_ROOT = os.path.join(BASE_DIR, "collected_static")
+STATICFILES_STORAGE = 'pizza_shop.assets.CompressedManifestStaticFilesStorage'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 MEDIA_URL = '/media/'
@@ -152,4 +180,55 @@ THOUSAND_SEPARATOR = ' '
 
 THUMBNAIL_DEBUG = DEBUG
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Live carts of CART_STORE = 'cache'. That needs a shared backend which never evicts, like redis or a large
+    # enough memcached: `manage.py check` refuses this per-process one, as it would LocMem, file or db caches.
+    'carts': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'carts',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
+# 'db' keeps open carts in Cart/CartMeal, 'cache' keeps them in the CART_STORE_CACHE cache and writes them
+# at checkout, at login and every CART_STORE_FLUSH_INTERVAL seconds. Several workers need a shared cache.
+CART_STORE = 'db'
+CART_STORE_CACHE = 'carts'
+CART_STORE_FLUSH_INTERVAL = 60
+# Seconds a written cart stays in the cache, changed carts stay until they are written
+CART_STORE_TIMEOUT = 3600
+
+# Rendered catalog fragments, pizza_shop.fragments.FileLRUCache with a 'location' is shared by all workers.
+# The catalog version lives in the default cache, so several workers need a shared CACHES backend too.
+FRAGMENT_CACHE = {
+    'BACKEND': 'pizza_shop.fragments.LocMemLRUCache',
+    'OPTIONS': {'max_entries': 5000},
+}
+
+# Requests with more ORM queries are logged and counted on /metrics/, METRICS_LOG logs every request
+METRICS_QUERY_BUDGET = 20
+METRICS_LOG = False
+# Without DEBUG queries are only counted with METRICS_QUERIES, it logs every statement of every request
+METRICS_QUERIES = False
+# Scrapers send 'Authorization: Bearer <METRICS_TOKEN>' to read /metrics/, staff users need no token
+METRICS_TOKEN = None
+
+# Queries slower than this or run this many times in one request are logged with the template line and
+# stack they come from, and counted per view on /metrics/. None switches a check off.
+QUERYLOG_SLOW_MS = 100
+QUERYLOG_DUPLICATES = 5
+
+# Share of requests whose stacks are sampled every PROFILE_INTERVAL seconds, requests with the
+# X-Profile header from `manage.py profile_summary --token` are always profiled
+PROFILE_SAMPLE_RATE = 0
+PROFILE_INTERVAL = 0.005
+PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+
+# Threads building MealImage thumbnails, 0 builds them inside the request. manage.py build_thumbnails
+# builds the thumbnails of all images in processes of its own.
+THUMBNAIL_WORKERS = 2
+
 from .local_settings import *
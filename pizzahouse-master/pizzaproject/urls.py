@@ -18,6 +18,7 @@ from django.conf.urls.static import static
 from django.contrib import admin
 
 import pizza_shop.urls
+from pizza_shop.assets import serve_asset
 from pizzaproject import settings
 
 urlpatterns = [
@@ -26,3 +27,9 @@ urlpatterns = [
 
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
+if not settings.DEBUG:
+    # runserver serves static itself in DEBUG, otherwise hand out the built assets with long-lived headers
+    urlpatterns += [
+        url(r'^%s(?P<path>.*)$' % settings.STATIC_URL.lstrip('/'), serve_asset),
+    ]
+